@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# coding: UTF-8
+"""Compares the HTTP/1.1 and the HTTP/2 transport of get_video_from_m3u.py.
+
+Downloads all segments of a playlist with both transports and prints the
+achieved throughput.
+
+With --serve the segments come from a built-in HTTPS server that speaks
+both HTTP/1.1 and HTTP/2. Like --http2 it needs the h2 package, and the
+openssl command for a self-signed certificate:
+
+	python bench_transport.py --serve
+
+The built-in server is written in Python and may be the bottleneck itself.
+To benchmark against a real server generate some small segments and serve
+them over HTTPS with a server that speaks both HTTP/1.1 and HTTP/2 (e.g.
+Caddy, h2o or nginx with http2 enabled):
+
+	mkdir segments && cd segments
+	echo '#EXTM3U' > index.m3u8
+	for i in $(seq 0 499); do
+		head -c 200K /dev/urandom > $i.ts
+		printf '#EXTINF:2.0,\\n%d.ts\\n' $i >> index.m3u8
+	done
+
+	python bench_transport.py --insecure https://localhost:8443/index.m3u8
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import ssl
+import socket
+import shutil
+import tempfile
+import subprocess
+from time import time
+from threading import Thread
+from collections import OrderedDict
+
+try:
+	from Queue import Queue, Empty
+except ImportError:
+	from queue import Queue, Empty
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler
+except ImportError:
+	from http.server import BaseHTTPRequestHandler
+
+try:
+	import h2.config
+	import h2.events
+	import h2.connection
+except ImportError:
+	has_h2 = False
+else:
+	has_h2 = True
+
+from get_video_from_m3u import open_session, parse_m3u8, fetch_chunk
+
+SERVE_SEGMENTS     = 500
+SERVE_SEGMENT_SIZE = 200 * 1024
+
+class NullWriter(object):
+	def write(self, data):
+		pass
+
+def content_type(path):
+	return 'application/vnd.apple.mpegurl' if path.endswith('.m3u8') else 'video/mp2t'
+
+class HTTP1Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		body = self.server.files.get(self.path)
+		if body is None:
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', content_type(self.path))
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class BenchServer(object):
+	# serves files from memory over HTTPS, HTTP/2 if the client asks for it
+	def __init__(self, files, certfile, keyfile):
+		self.files = files
+		self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+		self.context.load_cert_chain(certfile, keyfile)
+		self.context.set_alpn_protocols(['h2', 'http/1.1'])
+		self.sock = socket.socket()
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('localhost', 0))
+		self.sock.listen(64)
+		self.port = self.sock.getsockname()[1]
+		thread = Thread(target=self._accept)
+		thread.daemon = True
+		thread.start()
+
+	def _accept(self):
+		while True:
+			sock, addr = self.sock.accept()
+			# like the usual web servers, HTTP/2 waits for window updates otherwise
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			thread = Thread(target=self._handle, args=(sock, addr))
+			thread.daemon = True
+			thread.start()
+
+	def _handle(self, sock, addr):
+		try:
+			sock = self.context.wrap_socket(sock, server_side=True)
+			if sock.selected_alpn_protocol() == 'h2':
+				self._handle_h2(sock)
+			else:
+				HTTP1Handler(sock, addr, self)
+		except (socket.error, ssl.SSLError):
+			pass
+		finally:
+			sock.close()
+
+	def _handle_h2(self, sock):
+		conn = h2.connection.H2Connection(config=h2.config.H2Configuration(
+			client_side=False, header_encoding='utf-8'))
+		conn.initiate_connection()
+		sock.sendall(conn.data_to_send())
+
+		pending = OrderedDict() # stream id -> [body, offset]
+		while True:
+			# send as much as the flow control windows allow, then wait
+			# for the client to open them again
+			for stream_id, item in list(pending.items()):
+				body, offset = item
+				while offset < len(body):
+					size = min(conn.local_flow_control_window(stream_id),
+					           conn.max_outbound_frame_size, len(body) - offset)
+					if size <= 0:
+						break
+					conn.send_data(stream_id, body[offset:offset + size])
+					offset += size
+				item[1] = offset
+				if offset == len(body):
+					conn.end_stream(stream_id)
+					del pending[stream_id]
+			sock.sendall(conn.data_to_send())
+
+			data = sock.recv(65536)
+			if not data:
+				break
+
+			for event in conn.receive_data(data):
+				if isinstance(event, h2.events.RequestReceived):
+					path = dict(event.headers)[':path']
+					body = self.files.get(path)
+					if body is None:
+						conn.send_headers(event.stream_id, [(':status', '404')], end_stream=True)
+					else:
+						conn.send_headers(event.stream_id, [
+							(':status', '200'), ('content-type', content_type(path)),
+							('content-length', str(len(body)))])
+						pending[event.stream_id] = [body, 0]
+				elif isinstance(event, h2.events.StreamReset):
+					pending.pop(event.stream_id, None)
+				elif isinstance(event, h2.events.ConnectionTerminated):
+					return
+			sock.sendall(conn.data_to_send())
+
+	def close(self):
+		self.sock.close()
+
+def serve_segments(tmpdir):
+	certfile = os.path.join(tmpdir, 'cert.pem')
+	keyfile  = os.path.join(tmpdir, 'key.pem')
+	with open(os.devnull, 'wb') as devnull:
+		subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+			'-subj', '/CN=localhost', '-days', '1', '-keyout', keyfile, '-out', certfile],
+			stdout=devnull, stderr=devnull)
+
+	files = {}
+	playlist = ['#EXTM3U']
+	for i in range(SERVE_SEGMENTS):
+		files['/%d.ts' % i] = os.urandom(SERVE_SEGMENT_SIZE)
+		playlist.append('#EXTINF:2.0,\n%d.ts' % i)
+	files['/index.m3u8'] = ('\n'.join(playlist) + '\n').encode('utf-8')
+
+	return BenchServer(files, certfile, keyfile)
+
+def bench(http2, m3u_url, thread_count, verify):
+	with open_session(http2) as session:
+		session.verify = verify
+		if not verify:
+			# otherwise REQUESTS_CA_BUNDLE takes precedence over session.verify
+			session.trust_env = False
+		resp = session.get(m3u_url)
+		resp.raise_for_status()
+		playlist = parse_m3u8(resp.text, m3u_url)
+
+		queue = Queue()
+		for track in playlist.tracks:
+			queue.put_nowait(track.url)
+
+		sizes  = []
+		errors = []
+		def worker_func():
+			while True:
+				try:
+					url = queue.get_nowait()
+				except Empty:
+					break
+				try:
+					sizes.append(fetch_chunk(session, url, {}, NullWriter()))
+				except Exception as e:
+					errors.append(e)
+
+		start_time = time()
+		workers = [Thread(target=worker_func) for i in range(thread_count)]
+		for thread in workers:
+			thread.start()
+		for thread in workers:
+			thread.join()
+		elapsed = time() - start_time
+
+	if errors:
+		raise errors[0]
+
+	return len(sizes), sum(sizes), elapsed
+
+def main(args):
+	thread_count = 6
+	rounds = 3
+	verify = True
+	serve = False
+	while args:
+		arg = args[0]
+		if arg.startswith('--thread-count='):
+			thread_count = int(arg.split('=',1)[1])
+		elif arg.startswith('--rounds='):
+			rounds = int(arg.split('=',1)[1])
+		elif arg == '--insecure':
+			verify = False
+		elif arg == '--serve':
+			serve = True
+		elif arg == '--help':
+			print('Usage: bench_transport.py [--thread-count=COUNT] [--rounds=COUNT] [--insecure] (--serve | M3U_URL)')
+			return
+		else:
+			break
+		del args[0]
+
+	if len(args) != (0 if serve else 1):
+		print('Usage: bench_transport.py [--thread-count=COUNT] [--rounds=COUNT] [--insecure] (--serve | M3U_URL)', file=sys.stderr)
+		sys.exit(1)
+
+	server = None
+	if serve:
+		if not has_h2:
+			print('--serve needs the h2 package (pip install h2)', file=sys.stderr)
+			sys.exit(1)
+		tmpdir = tempfile.mkdtemp()
+		try:
+			server = serve_segments(tmpdir)
+		finally:
+			shutil.rmtree(tmpdir)
+		m3u_url = 'https://localhost:%d/index.m3u8' % server.port
+		verify = False
+	else:
+		m3u_url = args[0]
+
+	try:
+		for http2 in (False, True):
+			name = 'HTTP/2  ' if http2 else 'HTTP/1.1'
+			for i in range(rounds):
+				count, size, elapsed = bench(http2, m3u_url, thread_count, verify)
+				print('%s round %d: %d segments, %.1f MiB in %.2f s, %.2f MiB/s' % (
+					name, i + 1, count, size / 1024 / 1024, elapsed, size / 1024 / 1024 / elapsed))
+	finally:
+		if server is not None:
+			server.close()
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -11,19 +11,44 @@ import shlex
 import traceback
 import requests
 import requests.utils
+import requests.adapters
+import requests.cookies
+import urllib3.exceptions
 import json
 import shutil
-from time import time
+import stat
+import errno
+import socket
+import select
+import ssl
+import tempfile
+import uuid
+import calendar
+from io import BytesIO
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop
+from collections import OrderedDict, deque
+from time import time, sleep
 from lxml import html
 from urlparse import urljoin, urlparse
-from threading import Thread
+from threading import Thread, Lock, Event, Semaphore, Condition, current_thread, local
 from contextlib import closing
 from urllib import quote
 
 try:
-	from Queue import Queue
+	from Queue import Queue, Empty
 except ImportError:
-	from queue import Queue
+	from queue import Queue, Empty
+
+try:
+	import SocketServer as socketserver
+except ImportError:
+	import socketserver
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
 
 try:
 	import dbus
@@ -32,17 +57,103 @@ except ImportError:
 else:
 	has_dbus = True
 
+try:
+	import h2.config
+	import h2.events
+	import h2.connection
+except ImportError:
+	has_h2 = False
+else:
+	has_h2 = True
+
 RE_PARAM = re.compile(r'\s*(?P<name>[-a-z][-a-z0-9]*)\s*=\s*(:?"(?P<qstr>[^\n\r"]*)"|(?P<str>[^,\s]*))\s*', re.I)
 RE_DELIM = re.compile(r'\s*,\s*')
+RE_DATE  = re.compile(r'(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d(?:\.\d*)?)\s*(?:[Zz]|([-+])(\d\d):?(\d\d))?$')
 CAPTION = 'Get Video from M3U'
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.157 Safari/537.36'
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+PROGRESS_RATE = 5 # progress bar updates per second
+THROUGHPUT_WINDOW = 10 # seconds of downloads the throughput estimate is based on
+SWITCH_UP_FACTOR   = 0.7 # use at most this fraction of the throughput for a new stream
+SWITCH_DOWN_FACTOR = 0.9 # keep the current stream while it needs less than this fraction
+SWITCH_UP_SEGMENTS = 3 # segments to download before switching to a better stream again
+PREFETCH_MAX_PARTS = 64 # prefetched low-latency parts to keep in memory
+HTTP2_MAX_STREAMS = 32 # concurrent HTTP/2 streams per origin
+HTTP2_WINDOW = 16 * 1024 * 1024 # HTTP/2 receive window per stream and connection
+H2_SETTINGS_INITIAL_WINDOW_SIZE = 0x4
+H2_ERROR_CANCEL = 0x8
+# connection specific headers aren't allowed in HTTP/2
+H2_SKIP_HEADERS = frozenset(['host', 'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade', 'accept-encoding'])
+MIRROR_ALPHA = 0.3 # weight of the newest sample in the per host statistics
+MIRROR_ERROR_PENALTY = 30 # seconds added to a host's score at a 100% error rate
+LEASE_SIZE = 8 # consecutive chunks leased to a remote worker at once
+LEASE_TIMEOUT = 60 # seconds without progress after which leased chunks are handed out again
+CHUNK_RETRIES = 3 # times a failed chunk download is retried before giving up
+DAEMON_POOL_SIZE = 32 # connections per host kept open between daemon jobs
+
+# options of a daemon job and their defaults
+JOB_OPTIONS = {
+	'live_assemble':  False,
+	'ffmpeg':         None, # default: use ffmpeg if it exists
+	'keep_cache':     False,
+	'thread_count':   6,
+	'buffer_size':    DEFAULT_BUFFER_SIZE,
+	'auto_variant':   False,
+	'remux_jobs':     1,
+	'prefetch_parts': False,
+	'http2':          False,
+	'clips':          [],
+	'exact_trim':     False,
+	'skip_ads':       False,
+	'preview':        0,
+	'fsync':          0
+}
 DROP_HEADERS = {'if-none-match', 'if-modified-since', 'accept-encoding', 'upgrade-insecure-requests', 'connection'}
 
-EXT_WITH_ATTRS = {'EXT-X-MEDIA', 'EXT-X-STREAM-INF', 'EXT-X-I-FRAME-STREAM-INF', 'EXT-X-KEY', 'EXT-X-MAP', 'EXT-X-I-FRAME-STREAM-INF'}
+EXT_WITH_ATTRS = {'EXT-X-MEDIA', 'EXT-X-STREAM-INF', 'EXT-X-I-FRAME-STREAM-INF', 'EXT-X-KEY', 'EXT-X-MAP', 'EXT-X-PART', 'EXT-X-PART-INF', 'EXT-X-PRELOAD-HINT', 'EXT-X-DATERANGE'}
+
+CUE_TOLERANCE = 0.5 # seconds an ad break may end before its announced duration
+PREVIEW_WIDTH = 320 # pixels
+RECV_SIZE = 256 * 1024 # bytes read from a response at once
+WRITE_QUEUE_SIZE = 8 # chunks waiting to be written, in addition to one per download thread
+FSYNC_INTERVAL = 5 # seconds a written chunk waits at most for the next batched fsync
 
 def mkquery(**query):
 	return '&'.join(quote(k) + '=' + quote(query[k]) for k in query)
 
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+def parse_size(value):
+	value = value.strip().lower()
+	if value.endswith('ib'):
+		value = value[:-2]
+	elif value.endswith('b'):
+		value = value[:-1]
+	unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+	if unit:
+		value = value[:-1]
+	return int(float(value) * SIZE_UNITS[unit])
+
+def parse_time(value):
+	# [[HH:]MM:]SS[.fff] -> seconds
+	seconds = 0.0
+	for part in value.strip().split(':'):
+		seconds = seconds * 60 + float(part)
+	return seconds
+
+def parse_clip(value):
+	# START-END -> [start, end], either side may be empty
+	start, end = value.split('-', 1)
+	return [parse_time(start) if start.strip() else 0.0, parse_time(end) if end.strip() else None]
+
+def is_stream_output(outfile):
+	if outfile == '-':
+		return True
+	try:
+		return stat.S_ISFIFO(os.stat(outfile).st_mode)
+	except OSError:
+		return False
+
 def fmt_span(seconds):
 	minutes  = seconds // 60
 	seconds -= minutes * 60
@@ -103,6 +214,10 @@ def check_call_errmsg(cmd, stdout=None):
 	return out
 
 class GUI(object):
+	def __init__(self, out=None):
+		# messages go to stderr when the video is streamed to stdout
+		self.out = out or sys.stdout
+
 	def inputbox(self, msg, init=''):
 		raise NotImplementedError
 
@@ -125,7 +240,7 @@ class GUI(object):
 		raise NotImplementedError
 
 	def log(self, msg):
-		print(msg)
+		print(msg, file=self.out)
 
 	def __enter__(self):
 		return self
@@ -242,7 +357,8 @@ class KDialogProgressBar(ProgressBar):
 			pass
 
 class TextProgressBar(ProgressBar):
-	def __init__(self, label, maximum):
+	def __init__(self, label, maximum, out=None):
+		self._out = out or sys.stdout
 		self._label = label
 		self._maximum = maximum
 		self._value = 0
@@ -278,21 +394,207 @@ class TextProgressBar(ProgressBar):
 
 	def _redraw(self):
 		bar = '=' * self._barlen + '>'
-		sys.stdout.write('\r%s [%-80s]        ' % (self._label, bar))
+		self._out.write('\r%s [%-80s]        ' % (self._label, bar))
+
+	def __exit__(self, ex_type=None, ex_value=None, ex_traceback=None):
+		self._out.write('\n')
+
+class NullSpan(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, ex_type=None, ex_value=None, ex_traceback=None):
+		pass
+
+	def set(self, key, value):
+		pass
+
+class NullTracer(object):
+	span_obj = NullSpan()
+
+	def span(self, name, cat='download', **args):
+		return self.span_obj
+
+	def close(self):
+		pass
+
+NULL_TRACER = NullTracer()
+
+class TraceSpan(object):
+	__slots__ = 'tracer', 'name', 'cat', 'args', 'start', 'sampled'
+
+	def __init__(self, tracer, name, cat, args):
+		self.tracer  = tracer
+		self.name    = name
+		self.cat     = cat
+		self.args    = args
+		self.start   = None
+		self.sampled = False
+
+	def __enter__(self):
+		self.sampled = self.tracer._enter(self.name)
+		self.start   = time()
+		return self
 
 	def __exit__(self, ex_type=None, ex_value=None, ex_traceback=None):
-		sys.stdout.write('\n')
+		end = time()
+		self.tracer._exit()
+		if self.sampled:
+			if ex_type is not None:
+				self.args['error'] = ex_type.__name__
+			self.tracer._emit(self, end)
+
+	def set(self, key, value):
+		self.args[key] = value
+
+class Tracer(object):
+	# Chrome trace event format. Of the top level spans with the same name only
+	# every sample-th of a thread is recorded, with everything nested in it.
+	def __init__(self, path, sample=1):
+		self.sample  = max(sample, 1)
+		self.pid     = os.getpid()
+		self.start   = time()
+		self.lock    = Lock()
+		self.local   = local()
+		self.threads = set()
+		self.first   = True
+		self.fp      = open(path, 'w')
+		self.fp.write('[\n')
+
+	def span(self, name, cat='download', **args):
+		return TraceSpan(self, name, cat, args)
+
+	def _enter(self, name):
+		state = self.local
+		depth = getattr(state, 'depth', 0)
+		if depth == 0:
+			counts = getattr(state, 'counts', None)
+			if counts is None:
+				counts = state.counts = {}
+			count = counts.get(name, 0)
+			counts[name] = count + 1
+			state.sampled = count % self.sample == 0
+		state.depth = depth + 1
+		return state.sampled
+
+	def _exit(self):
+		self.local.depth -= 1
+
+	def _emit(self, span, end):
+		thread = current_thread()
+		event  = {
+			'name': span.name,
+			'cat':  span.cat,
+			'ph':   'X',
+			'ts':   int((span.start - self.start) * 1000000),
+			'dur':  int((end - span.start) * 1000000),
+			'pid':  self.pid,
+			'tid':  thread.ident
+		}
+		if span.args:
+			event['args'] = span.args
+
+		with self.lock:
+			if self.fp is None:
+				return
+			if thread.ident not in self.threads:
+				self.threads.add(thread.ident)
+				self._write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': thread.ident,
+					'args': {'name': thread.name}})
+			self._write(event)
+
+	def _write(self, event):
+		if not self.first:
+			self.fp.write(',\n')
+		self.first = False
+		self.fp.write(json.dumps(event))
+
+	def close(self):
+		with self.lock:
+			if self.fp is not None:
+				self.fp.write('\n]\n')
+				self.fp.close()
+				self.fp = None
+
+class ProgressReporter(ProgressBar):
+	# the setters only record the latest value, a background thread pushes it
+	# to the (possibly slow) progress bar and polls for cancellation
+	def __init__(self, bar, rate=PROGRESS_RATE, tracer=NULL_TRACER):
+		self.bar       = bar
+		self.tracer    = tracer
+		self.interval  = 1.0 / rate
+		self.cancelled = Event()
+		self._closed   = Event()
+		self._lock     = Lock()
+		self._pending  = {}
+		self._thread   = Thread(target=self._run, name='progress')
+		self._thread.daemon = True
+
+	def wasCancelled(self):
+		return self.cancelled.is_set()
+
+	def setMaximum(self, maximum):
+		self._set('maximum', maximum)
+
+	def setValue(self, value):
+		self._set('value', value)
+
+	def setLabelText(self, label):
+		self._set('label', label)
+
+	def _set(self, key, value):
+		with self._lock:
+			self._pending[key] = value
+
+	def _flush(self):
+		with self._lock:
+			pending = self._pending
+			self._pending = {}
+
+		if not pending:
+			return
+
+		with self.tracer.span('progress update', 'gui'):
+			if 'maximum' in pending:
+				self.bar.setMaximum(pending['maximum'])
+
+			if 'value' in pending:
+				self.bar.setValue(pending['value'])
+
+			if 'label' in pending:
+				self.bar.setLabelText(pending['label'])
+
+	def _run(self):
+		while not self._closed.wait(self.interval):
+			self._flush()
+			with self.tracer.span('cancel poll', 'gui'):
+				cancelled = self.bar.wasCancelled()
+			if cancelled:
+				self.cancelled.set()
+
+	def __enter__(self):
+		self.bar.__enter__()
+		self._thread.start()
+		return self
+
+	def __exit__(self, ex_type=None, ex_value=None, ex_traceback=None):
+		self._closed.set()
+		self._thread.join()
+		self._flush()
+		return self.bar.__exit__(ex_type, ex_value, ex_traceback)
 
 YES = {'y', 'yes', '1', 'true', 't', 'on'}
 NO  = {'n', 'no', '0', 'false', 'f', 'off'}
 
 class TextGUI(GUI):
 	def inputbox(self, msg, init=''):
-		sys.stdout.write('\x1B[?25h')
+		self.out.write('\x1B[?25h')
 		try:
-			return raw_input(msg + ' ')
+			self.out.write(msg + ' ')
+			self.out.flush()
+			return raw_input()
 		finally:
-			sys.stdout.write('\x1B[?25l')
+			self.out.write('\x1B[?25l')
 
 	def warning_yes_no(self, text):
 		while True:
@@ -305,12 +607,12 @@ class TextGUI(GUI):
 
 	def menu(self, text, items, default=None):
 		while True:
-			print(text)
+			print(text, file=self.out)
 			for index, (tag, item) in enumerate(items):
 				s = '%d %s' % (index + 1, item)
 				if tag == default:
 					s += ' (default)'
-				print(s)
+				print(s, file=self.out)
 			value = self.inputbox('choice (1-%d):').strip()
 			if not value and default is not None:
 				return default
@@ -321,7 +623,7 @@ class TextGUI(GUI):
 				return items[value][0]
 			except (IndexError, ValueError):
 				pass
-			print('')
+			print('', file=self.out)
 
 	def get_save_filename(self, dirname=None, filter=None):
 		while True:
@@ -330,23 +632,23 @@ class TextGUI(GUI):
 				return path
 
 	def passive_popup(self, text, timeout=5):
-		print(text)
+		print(text, file=self.out)
 
 	def show_error(self, text):
 		sys.stderr.write('*** Error: %s\n' % text)
 
 	def progressbar(self, text, maximum):
-		return TextProgressBar(text, maximum)
+		return TextProgressBar(text, maximum, self.out)
 
 	def log(self, msg):
 		pass
 
 	def __enter__(self):
-		sys.stdout.write('\x1B[?25l')
+		self.out.write('\x1B[?25l')
 		return self
 
 	def __exit__(self, ex_type=None, ex_value=None, ex_traceback=None):
-		sys.stdout.write('\x1B[?25h')
+		self.out.write('\x1B[?25h')
 
 class Track(object):
 	__slots__ = 'url', 'meta'
@@ -376,6 +678,57 @@ class Playlist(object):
 		self.tracks = []
 		self.meta   = {}
 
+class SpillBuffer(object):
+	# keeps chunks in memory up to max_memory, beyond that they are spilled
+	# into a temporary directory
+	def __init__(self, max_memory):
+		self.max_memory  = max_memory
+		self.memory_used = 0
+		self.spilldir    = None
+		self.chunks      = {}
+		self.lock        = Lock()
+
+	def put(self, index, data):
+		with self.lock:
+			if self.memory_used + len(data) <= self.max_memory:
+				self.memory_used += len(data)
+				self.chunks[index] = (data, None)
+				return
+
+			if self.spilldir is None:
+				self.spilldir = tempfile.mkdtemp(prefix='get_video_from_m3u.')
+			path = os.path.join(self.spilldir, '%d.ts' % index)
+
+		with open(path, 'wb') as fp:
+			fp.write(data)
+
+		with self.lock:
+			self.chunks[index] = (None, path)
+
+	def __contains__(self, index):
+		with self.lock:
+			return index in self.chunks
+
+	def pop(self, index):
+		with self.lock:
+			data, path = self.chunks.pop(index)
+			if data is not None:
+				self.memory_used -= len(data)
+				return data
+
+		with open(path, 'rb') as fp:
+			data = fp.read()
+		os.unlink(path)
+		return data
+
+	def close(self):
+		with self.lock:
+			self.chunks.clear()
+			self.memory_used = 0
+			if self.spilldir is not None:
+				shutil.rmtree(self.spilldir, ignore_errors=True)
+				self.spilldir = None
+
 def parse_meta(line):
 	meta = {}
 	if line[:1] == '#':
@@ -429,20 +782,288 @@ def track_sort_key(track):
 	else:
 		return 480, 640
 
+def variant_sort_key(track):
+	return (track.meta.get('BANDWIDTH', 0),) + track_sort_key(track)
+
+def select_variant(variants, bandwidth, current=None):
+	# the current variant is kept as long as it fits, so that a slightly
+	# lower throughput estimate doesn't cause a switch
+	ranked  = sorted(variants, key=variant_sort_key)
+	fitting = [track for track in ranked if track.meta.get('BANDWIDTH', 0) <= bandwidth * SWITCH_UP_FACTOR]
+	best    = fitting[-1] if fitting else ranked[0]
+
+	if current is not None:
+		current_key = variant_sort_key(current)
+		if variant_sort_key(best) < current_key and \
+			current.meta.get('BANDWIDTH', 0) <= bandwidth * SWITCH_DOWN_FACTOR:
+			return current
+
+	return best
+
+def variant_key(track):
+	# redundant streams only differ in their URL
+	meta = track.meta
+	return (meta.get('BANDWIDTH'), tuple(meta.get('RESOLUTION') or ()), tuple(meta.get('CODECS') or ()))
+
+def unique_variants(variants):
+	unique = OrderedDict()
+	for track in variants:
+		unique.setdefault(variant_key(track), track)
+	return list(unique.values())
+
+def variant_mirrors(variants, variant):
+	key = variant_key(variant)
+	return [track.url for track in variants if variant_key(track) == key and track.url != variant.url]
+
+def attach_mirrors(tracks, mirror_playlists):
+	# segments are matched by media sequence number
+	for mirror_playlist in mirror_playlists:
+		by_sequence = dict((track.meta.get('SEQUENCE'), track.url) for track in mirror_playlist.tracks)
+		for track in tracks:
+			url = by_sequence.get(track.meta.get('SEQUENCE'))
+			if url is not None and url != track.url:
+				track.meta.setdefault('MIRRORS', []).append(url)
+
+def new_tracks(tracks, new_playlist):
+	if tracks and 'SEQUENCE' in tracks[-1].meta:
+		last_sequence = tracks[-1].meta['SEQUENCE']
+		return [track for track in new_playlist.tracks if track.meta.get('SEQUENCE', -1) > last_sequence]
+
+	known_urls = set(track.url for track in tracks)
+	for i, track in enumerate(new_playlist.tracks):
+		if track.url not in known_urls:
+			return new_playlist.tracks[i:]
+	return []
+
 EXT_PARSERS = {
 	'EXT-X-STREAM-INF': {
 		'BANDWIDTH':       lambda val, quoted: int(val, 10),
 		'CODECS':          lambda val, quoted: val.split(',') if val else [],
 		'RESOLUTION':      lambda val, quoted: tuple(int(px) for px in val.split('x', 1)),
 		'CLOSED-CAPTIONS': lambda val, quoted: val if quoted or val != 'NONE' else None
+	},
+	'EXT-X-I-FRAME-STREAM-INF': {
+		'BANDWIDTH':       lambda val, quoted: int(val, 10),
+		'CODECS':          lambda val, quoted: val.split(',') if val else [],
+		'RESOLUTION':      lambda val, quoted: tuple(int(px) for px in val.split('x', 1))
+	},
+	'EXT-X-DATERANGE': {
+		'DURATION':         lambda val, quoted: float(val),
+		'PLANNED-DURATION': lambda val, quoted: float(val)
 	}
 }
 
+def parse_byterange(value, next_offset=0):
+	# LENGTH[@OFFSET] -> [offset, length], without an offset the range
+	# follows the previous one
+	length, _, offset = value.partition('@')
+	return [int(offset, 10) if offset else next_offset, int(length, 10)]
+
+def parse_cue_duration(params):
+	# known forms: 30, DURATION=30, 10/30 and ElapsedTime=10,Duration=30
+	if not params:
+		return None
+
+	attrs = {}
+	for item in params.split(','):
+		if '=' in item:
+			key, value = item.split('=', 1)
+			attrs[key.strip().upper()] = value.strip().strip('"')
+
+	try:
+		if 'DURATION' in attrs:
+			return float(attrs['DURATION']) - float(attrs.get('ELAPSEDTIME', 0))
+		if '/' in params:
+			elapsed, duration = params.split('/', 1)
+			return float(duration) - float(elapsed)
+		return float(params)
+	except ValueError:
+		return None
+
+def parse_date(value):
+	# ISO 8601 date -> seconds since the epoch, None if it can't be parsed
+	m = RE_DATE.match(value.strip())
+	if not m:
+		return None
+	year, month, day, hour, minute = (int(group, 10) for group in m.group(1, 2, 3, 4, 5))
+	seconds = calendar.timegm((year, month, day, hour, minute, 0)) + float(m.group(6))
+	if m.group(7):
+		offset = int(m.group(8), 10) * 3600 + int(m.group(9), 10) * 60
+		seconds += -offset if m.group(7) == '+' else offset
+	return seconds
+
+def attach_dateranges(tracks, dateranges):
+	# a date range starts at the segment whose EXT-X-PROGRAM-DATE-TIME covers its
+	# START-DATE, without dates at the segment the tag was placed before.
+	# SCTE-35 outs mark the segments until the matching in or their duration ran out
+	dated = [index for index, track in enumerate(tracks) if 'PROGRAM-DATE-TIME' in track.meta]
+	dates = [tracks[index].meta['PROGRAM-DATE-TIME'] for index in dated]
+	end   = dates[-1] + tracks[-1].meta.get('DURATION', 0) if dates else None
+	starts = {} # segment index -> [(seconds the range started before it, date range)]
+	for position, daterange in dateranges:
+		index, elapsed = position, 0
+		start = parse_date(daterange.get('START-DATE', ''))
+		if dates and start is not None:
+			if start + CUE_TOLERANCE >= end:
+				# not in the playlist yet
+				continue
+			k = bisect_right(dates, start + CUE_TOLERANCE) - 1
+			if k < 0:
+				# started before the oldest segment of a live playlist
+				index, elapsed = dated[0], dates[0] - start
+			else:
+				index = dated[k]
+		elif index >= len(tracks):
+			continue
+		tracks[index].meta.setdefault('DATERANGE', []).append(daterange)
+		starts.setdefault(index, []).append((elapsed, daterange))
+
+	in_ad = False
+	ad_remaining = None
+	for index, track in enumerate(tracks):
+		for elapsed, daterange in starts.get(index, ()):
+			if 'SCTE35-OUT' in daterange:
+				ad_remaining = daterange.get('DURATION', daterange.get('PLANNED-DURATION'))
+				if ad_remaining is not None:
+					ad_remaining -= elapsed
+				in_ad = ad_remaining is None or ad_remaining > CUE_TOLERANCE
+			elif 'SCTE35-IN' in daterange:
+				in_ad = False
+		if in_ad:
+			track.meta['AD'] = True
+			if ad_remaining is not None:
+				ad_remaining -= track.meta.get('DURATION', 0)
+				in_ad = ad_remaining > CUE_TOLERANCE
+
+def has_discontinuity(tracks):
+	return any(track.meta.get('DISCONTINUITY') for track in tracks[1:])
+
+def skip_ad_tracks(tracks, discontinuity=False):
+	# also returns whether the tracks end in an ad break, pass that as
+	# discontinuity for the tracks that follow
+	kept = []
+	for track in tracks:
+		if track.meta.get('AD'):
+			discontinuity = True
+		else:
+			if discontinuity:
+				track.meta['DISCONTINUITY'] = True
+				discontinuity = False
+			kept.append(track)
+	return kept, discontinuity
+
+def clip_tracks(tracks, clips):
+	# returns the selected tracks and [first, end, skip, length] per window,
+	# first:end index the selected tracks (windows sharing a segment overlap)
+	offsets = []
+	total = 0.0
+	for track in tracks:
+		offsets.append(total)
+		total += track.meta.get('DURATION', 0)
+
+	windows = []
+	for start, end in sorted(clips, key=lambda clip: clip[0]):
+		start = max(start, 0.0)
+		end = total if end is None else min(end, total)
+		if start >= end:
+			continue
+		first = max(bisect_right(offsets, start) - 1, 0)
+		last  = bisect_left(offsets, end)
+		windows.append((first, last, start, end))
+
+	# windows may share segments, those are still only downloaded once
+	positions = {} # index in tracks -> index in selected
+	selected = []
+	ranges = []
+	for first, last, start, end in windows:
+		for i in range(first, last):
+			if i not in positions:
+				track = Track(tracks[i].url, dict(tracks[i].meta))
+				if selected and i - 1 not in positions:
+					# timestamps jump between windows
+					track.meta['DISCONTINUITY'] = True
+				positions[i] = len(selected)
+				selected.append(track)
+		skip = start - offsets[first]
+		length = None if end >= total else end - start
+		ranges.append([positions[first], positions[last - 1] + 1, skip, length])
+
+	return selected, ranges
+
+def remap_tracks(tracks, new_playlist, by_position=False):
+	# Points the tracks of a resumed download to the segments of the reloaded
+	# playlist with the same media sequence number. Returns the tracks that
+	# aren't in the reloaded playlist, their urls are probably expired.
+	by_sequence = dict((track.meta['SEQUENCE'], track) for track in new_playlist.tracks if 'SEQUENCE' in track.meta)
+	pairs = [(track, by_sequence.get(track.meta.get('SEQUENCE'))) for track in tracks]
+	if by_position and not any(new for track, new in pairs) and len(tracks) == len(new_playlist.tracks):
+		# a VOD that got renumbered, only safe because the segments can't shift
+		pairs = list(zip(tracks, new_playlist.tracks))
+
+	unmatched = []
+	for track, new in pairs:
+		if new is None:
+			unmatched.append(track)
+		else:
+			track.url = new.url
+			for key in ('BYTERANGE', 'MIRRORS', 'PARTS'):
+				if key in new.meta:
+					track.meta[key] = new.meta[key]
+				else:
+					track.meta.pop(key, None)
+	return unmatched
+
+def drop_tracks(tracks, drop, cached, cachedir):
+	# Removes the tracks in drop that aren't cached and moves the cached
+	# chunks of the following tracks to their new indices. Returns the
+	# remaining tracks and the indices of their cached chunks.
+	drop_ids = set(id(track) for track in drop)
+	kept = []
+	kept_cached = set()
+	discontinuity = False
+	for index, track in enumerate(tracks):
+		if id(track) in drop_ids and index not in cached:
+			discontinuity = True
+			continue
+
+		if discontinuity:
+			track.meta['DISCONTINUITY'] = True
+			discontinuity = False
+
+		new_index = len(kept)
+		if index in cached:
+			# new_index <= index and everything before was already moved
+			if new_index != index:
+				os.rename(os.path.join(cachedir, '%d.ts' % index), os.path.join(cachedir, '%d.ts' % new_index))
+			kept_cached.add(new_index)
+		kept.append(track)
+
+	return kept, kept_cached
+
 def parse_m3u8(data, base_url):
 	pl = Playlist()
 	lines = data.split("\n")
 	if lines:
 		if lines[0] == "#EXTM3U":
+			# media sequence numbers stay the same when a live playlist is
+			# reloaded and are aligned between the variants of a stream
+			sequence = 0
+			# low-latency parts that make up the next segment
+			parts = []
+			# markers that apply to the next segment
+			discontinuity = False
+			# date of the next segment, advanced by the durations after each tag
+			program_date = None
+			# (index of the following segment, attributes) of every date range
+			dateranges = []
+			# ad break state, ad_remaining is None if the end is only marked by a cue in
+			in_ad = False
+			ad_remaining = None
+			byterange = None
+			# url and end of the previous byte range
+			prev_range = (None, 0)
+			# EXTINF or EXT-X-STREAM-INF of the next uri, more tags may come in between
+			info = None
 			it = iter(lines)
 			next(it)
 			while True:
@@ -456,21 +1077,1476 @@ def parse_m3u8(data, base_url):
 					elif line.startswith('#'):
 						hdr, meta = parse_meta(line)
 						if hdr in ('EXTINF', 'EXT-X-STREAM-INF'):
-							url = next(it)
-							track = Track(urljoin(base_url, url))
-							track.meta.update(meta)
-							track.meta['STREAM'] = hdr == 'EXT-X-STREAM-INF'
-							pl.tracks.append(track)
+							info = hdr, meta
+						elif hdr == 'EXT-X-PART':
+							# byte range parts can't be joined to a segment, mark them with None
+							parts.append(None if 'BYTERANGE' in meta else urljoin(base_url, meta['URI']))
+						elif hdr == 'EXT-X-PRELOAD-HINT':
+							if meta.get('TYPE') == 'PART' and 'BYTERANGE-START' not in meta:
+								pl.meta[hdr] = urljoin(base_url, meta['URI'])
+						elif hdr == 'EXT-X-ENDLIST':
+							pl.meta[hdr] = True
+						elif hdr == 'EXT-X-BYTERANGE':
+							byterange = meta
+						elif hdr == 'EXT-X-I-FRAME-STREAM-INF':
+							meta['URI'] = urljoin(base_url, meta['URI'])
+							pl.meta.setdefault('I-FRAME-STREAMS', []).append(meta)
+						elif hdr == 'EXT-X-MAP':
+							meta['URI'] = urljoin(base_url, meta['URI'])
+							pl.meta[hdr] = meta
+						elif hdr == 'EXT-X-DISCONTINUITY':
+							discontinuity = True
+						elif hdr in ('EXT-X-CUE-OUT', 'EXT-X-CUE-OUT-CONT'):
+							in_ad = True
+							ad_remaining = parse_cue_duration(meta)
+						elif hdr == 'EXT-X-CUE-IN':
+							in_ad = False
+						elif hdr == 'EXT-X-PROGRAM-DATE-TIME':
+							pl.meta[hdr] = meta
+							program_date = parse_date(meta)
+						elif hdr == 'EXT-X-DATERANGE':
+							dateranges.append((len(pl.tracks), meta))
 						elif meta is not None:
 							pl.meta[hdr] = meta
+							if hdr == 'EXT-X-MEDIA-SEQUENCE':
+								sequence = int(meta, 10)
 					else:
-						pl.tracks.append(Track(urljoin(base_url, line)))
+						track = Track(urljoin(base_url, line))
+						if info is not None:
+							track.meta.update(info[1])
+						track.meta['STREAM'] = info is not None and info[0] == 'EXT-X-STREAM-INF'
+						info = None
+						if not track.meta['STREAM']:
+							track.meta['SEQUENCE'] = sequence
+							sequence += 1
+							if parts and None not in parts:
+								track.meta['PARTS'] = parts
+							parts = []
+							if discontinuity:
+								track.meta['DISCONTINUITY'] = True
+								discontinuity = False
+							if program_date is not None:
+								track.meta['PROGRAM-DATE-TIME'] = program_date
+								program_date += track.meta.get('DURATION', 0)
+							if in_ad:
+								track.meta['AD'] = True
+								if ad_remaining is not None:
+									ad_remaining -= track.meta.get('DURATION', 0)
+									in_ad = ad_remaining > CUE_TOLERANCE
+							if byterange is not None:
+								next_offset = prev_range[1] if prev_range[0] == track.url else 0
+								offset, length = parse_byterange(byterange, next_offset)
+								track.meta['BYTERANGE'] = [offset, length]
+								prev_range = (track.url, offset + length)
+								byterange = None
+						pl.tracks.append(track)
+
+			if dateranges:
+				attach_dateranges(pl.tracks, dateranges)
+			if parts and None not in parts:
+				pl.meta['PENDING-PARTS'] = parts
 		else:
 			for line in lines:
 				if line and not line.startswith('#'):
 					pl.tracks.append(Track(urljoin(base_url, line)))
 	return pl
 
+class ThroughputMeter(object):
+	# combined rate of all download threads in bits per second: the bytes of the
+	# downloads that ended in the window over the time any download was running,
+	# so parallel downloads add up and idle time between them doesn't count
+	def __init__(self, window=THROUGHPUT_WINDOW):
+		self.window    = window
+		self.transfers = deque()
+		self.estimate  = None
+		self.samples   = 0
+		self.lock      = Lock()
+
+	def add(self, size, seconds):
+		if seconds <= 0:
+			return
+		end = time()
+		with self.lock:
+			self.transfers.append((end - seconds, end, size))
+			# keep at least the newest download, even if it took longer than the window
+			while len(self.transfers) > 1 and self.transfers[0][1] < end - self.window:
+				self.transfers.popleft()
+
+			busy = 0
+			busy_start = busy_end = None
+			for start, stop, _ in sorted(self.transfers):
+				if busy_end is None or start > busy_end:
+					if busy_end is not None:
+						busy += busy_end - busy_start
+					busy_start, busy_end = start, stop
+				else:
+					busy_end = max(busy_end, stop)
+			busy += busy_end - busy_start
+
+			self.estimate = sum(size for _, _, size in self.transfers) * 8 / busy
+			self.samples += 1
+
+def socket_pair():
+	if hasattr(socket, 'socketpair'):
+		return socket.socketpair()
+	# Python 2 on Windows
+	server = socket.socket()
+	try:
+		server.bind(('127.0.0.1', 0))
+		server.listen(1)
+		client = socket.create_connection(server.getsockname())
+		return server.accept()[0], client
+	finally:
+		server.close()
+
+class HTTP2Headers(object):
+	# the parts of httplib's message cookielib needs for Set-Cookie headers
+	def __init__(self, headers):
+		self.headers = headers
+
+	def getheaders(self, name):
+		name = name.lower()
+		return [value for key, value in self.headers if key == name]
+
+	def get_all(self, name, default=None):
+		return self.getheaders(name) or default
+
+class HTTP2Stream(object):
+	# request and response of one stream, the response body is filled in by
+	# the I/O thread of the connection and read like urllib3's raw response
+	def __init__(self, connection, headers, body):
+		self.connection = connection
+		self.request    = (headers, body)
+		self.stream_id  = None
+		self.headers    = None
+		self.chunks     = []
+		self.done       = False
+		self.error      = None
+		self.cond       = Condition()
+
+	def response(self, headers):
+		with self.cond:
+			self.headers = headers
+			self.msg     = HTTP2Headers(headers)
+			self.cond.notify_all()
+
+	def feed(self, data):
+		with self.cond:
+			self.chunks.append(data)
+			self.cond.notify_all()
+
+	def finish(self, error=None):
+		with self.cond:
+			self.done  = True
+			self.error = error
+			self.cond.notify_all()
+
+	def wait_response(self):
+		with self.cond:
+			while self.headers is None and self.error is None:
+				self.cond.wait()
+			if self.headers is None:
+				raise self.error
+			return self.headers
+
+	# requests reads the cookies from the "original response"
+	@property
+	def _original_response(self):
+		return self
+
+	def read(self, amt=None):
+		with self.cond:
+			while not self.chunks and not self.done:
+				self.cond.wait()
+			if not self.chunks:
+				if self.error is not None:
+					raise self.error
+				return b''
+			if amt is None:
+				while not self.done:
+					self.cond.wait()
+				data = b''.join(self.chunks)
+				del self.chunks[:]
+				if self.error is not None:
+					raise self.error
+				return data
+			data = self.chunks[0]
+			if len(data) > amt:
+				self.chunks[0] = data[amt:]
+				return data[:amt]
+			del self.chunks[0]
+			return data
+
+	def readinto(self, buf):
+		data = self.read(len(buf))
+		buf[:len(data)] = data
+		return len(data)
+
+	def close(self):
+		if not self.done:
+			self.connection.cancel(self)
+
+class HTTP2Connection(object):
+	# One connection per origin that multiplexes the requests of all threads.
+	# Only its I/O thread touches the socket and the h2 state, threads submit
+	# streams and wait for their response.
+	def __init__(self, host, port, verify, max_streams):
+		context = ssl.create_default_context()
+		if verify is False:
+			context.check_hostname = False
+			context.verify_mode = ssl.CERT_NONE
+		elif verify is not True and os.path.isdir(verify):
+			context.load_verify_locations(capath=verify)
+		elif verify is not True:
+			context.load_verify_locations(cafile=verify)
+		context.set_alpn_protocols(['h2'])
+
+		try:
+			sock = socket.create_connection((host, port))
+		except socket.error as e:
+			raise requests.ConnectionError(e)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		try:
+			self.sock = context.wrap_socket(sock, server_hostname=host)
+		except (socket.error, ssl.SSLError) as e:
+			sock.close()
+			raise requests.exceptions.SSLError(e)
+		if self.sock.selected_alpn_protocol() != 'h2':
+			self.sock.close()
+			raise requests.ConnectionError('%s:%d does not support HTTP/2' % (host, port))
+
+		self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(
+			client_side=True, header_encoding='utf-8'))
+		self.conn.initiate_connection()
+		# received data is acknowledged right away, large windows save round trips
+		self.conn.update_settings({H2_SETTINGS_INITIAL_WINDOW_SIZE: HTTP2_WINDOW})
+		self.conn.increment_flow_control_window(HTTP2_WINDOW)
+		self.sock.sendall(self.conn.data_to_send())
+
+		self.max_streams = max_streams
+		self.queue   = Queue()
+		self.streams = {} # stream id -> HTTP2Stream
+		self.resets  = Queue()
+		self.closed  = False
+		self.lock    = Lock()
+		self.wake_r, self.wake_w = socket_pair()
+		self.thread  = Thread(target=self._run, name='http2 %s:%d' % (host, port))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def request(self, headers, body=None):
+		stream = HTTP2Stream(self, headers, body)
+		with self.lock:
+			if self.closed:
+				raise requests.ConnectionError('HTTP/2 connection is closed')
+			self.queue.put(stream)
+		self._wake()
+		stream.wait_response()
+		return stream
+
+	def cancel(self, stream):
+		self.resets.put(stream)
+		self._wake()
+
+	def close(self):
+		self.closed = True
+		self._wake()
+		if self.thread is not current_thread():
+			self.thread.join()
+
+	def _wake(self):
+		try:
+			self.wake_w.send(b'x')
+		except socket.error:
+			pass
+
+	def _run(self):
+		try:
+			while not self.closed:
+				self._start_streams()
+				self._reset_streams()
+				data = self.conn.data_to_send()
+				if data:
+					self.sock.sendall(data)
+
+				if not self.sock.pending():
+					readable = select.select([self.sock, self.wake_r], [], [])[0]
+					if self.wake_r in readable:
+						self.wake_r.recv(4096)
+					if self.sock not in readable:
+						continue
+
+				data = self.sock.recv(65536)
+				if not data:
+					raise requests.ConnectionError('HTTP/2 connection closed by server')
+				for event in self.conn.receive_data(data):
+					self._handle(event)
+			error = requests.ConnectionError('HTTP/2 connection closed')
+		except Exception as e:
+			error = e if isinstance(e, requests.RequestException) else requests.ConnectionError(e)
+
+		with self.lock:
+			self.closed = True
+		for stream in list(self.streams.values()):
+			stream.finish(error)
+		while True:
+			try:
+				self.queue.get_nowait().finish(error)
+			except Empty:
+				break
+		self.sock.close()
+		self.wake_r.close()
+		self.wake_w.close()
+
+	def _start_streams(self):
+		limit = min(self.max_streams, self.conn.remote_settings.max_concurrent_streams)
+		while len(self.streams) < limit:
+			try:
+				stream = self.queue.get_nowait()
+			except Empty:
+				break
+			headers, body = stream.request
+			stream.stream_id = self.conn.get_next_available_stream_id()
+			self.streams[stream.stream_id] = stream
+			self.conn.send_headers(stream.stream_id, headers, end_stream=not body)
+			if body:
+				self.conn.send_data(stream.stream_id, body, end_stream=True)
+
+	def _reset_streams(self):
+		while True:
+			try:
+				stream = self.resets.get_nowait()
+			except Empty:
+				break
+			if self.streams.pop(stream.stream_id, None) is stream:
+				self.conn.reset_stream(stream.stream_id, H2_ERROR_CANCEL)
+				stream.finish(requests.ConnectionError('stream was canceled'))
+
+	def _handle(self, event):
+		stream = self.streams.get(getattr(event, 'stream_id', None))
+		if isinstance(event, h2.events.ResponseReceived) and stream is not None:
+			stream.response(event.headers)
+		elif isinstance(event, h2.events.DataReceived):
+			self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+			if stream is not None:
+				stream.feed(event.data)
+		elif isinstance(event, h2.events.StreamEnded) and stream is not None:
+			del self.streams[event.stream_id]
+			stream.finish()
+		elif isinstance(event, h2.events.StreamReset) and stream is not None:
+			del self.streams[event.stream_id]
+			stream.finish(requests.ConnectionError('HTTP/2 stream reset by server (error %s)' % event.error_code))
+		elif isinstance(event, h2.events.ConnectionTerminated):
+			raise requests.ConnectionError('HTTP/2 connection terminated by server (error %s)' % event.error_code)
+
+class HTTP2Adapter(requests.adapters.BaseAdapter):
+	def __init__(self, max_streams=HTTP2_MAX_STREAMS):
+		super(HTTP2Adapter, self).__init__()
+		self.max_streams = max_streams
+		self.connections = {} # (host, port) -> HTTP2Connection
+		self.lock        = Lock()
+
+	def _connection(self, host, port, verify):
+		with self.lock:
+			conn = self.connections.get((host, port))
+			if conn is None or conn.closed:
+				conn = self.connections[(host, port)] = HTTP2Connection(host, port, verify, self.max_streams)
+			return conn
+
+	def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+		parsed = urlparse(request.url)
+		path = parsed.path or '/'
+		if parsed.query:
+			path += '?' + parsed.query
+		headers = [(':method', request.method), (':scheme', 'https'), (':authority', parsed.netloc), (':path', path)]
+		for name, value in request.headers.items():
+			name = name.lower()
+			if name not in H2_SKIP_HEADERS:
+				headers.append((name, value))
+		# urllib3 would decode compressed responses, nothing does here
+		headers.append(('accept-encoding', 'identity'))
+
+		h2stream = self._connection(parsed.hostname, parsed.port or 443, verify).request(headers, request.body)
+
+		resp = requests.Response()
+		resp.status_code = int(dict(h2stream.headers)[':status'], 10)
+		for name, value in h2stream.headers:
+			if not name.startswith(':'):
+				resp.headers[name] = resp.headers[name] + ', ' + value if name in resp.headers else value
+		resp.encoding   = requests.utils.get_encoding_from_headers(resp.headers)
+		resp.raw        = h2stream
+		resp.url        = request.url
+		resp.request    = request
+		resp.connection = self
+		requests.cookies.extract_cookies_to_jar(resp.cookies, request, h2stream)
+		if not stream:
+			resp.content
+		return resp
+
+	def close(self):
+		with self.lock:
+			for conn in self.connections.values():
+				conn.close()
+			self.connections.clear()
+
+class SharedAdapter(requests.adapters.BaseAdapter):
+	# closing a session doesn't close the shared adapter
+	def __init__(self, adapter):
+		super(SharedAdapter, self).__init__()
+		self.adapter = adapter
+
+	def send(self, request, **kwargs):
+		return self.adapter.send(request, **kwargs)
+
+	def close(self):
+		pass
+
+def open_session(http2=False, max_streams=HTTP2_MAX_STREAMS, adapters=None):
+	session = requests.session()
+	if adapters:
+		for prefix in adapters:
+			session.mount(prefix, adapters[prefix])
+	if http2:
+		if not has_h2:
+			raise ValueError('HTTP/2 support needs the h2 package (pip install h2)')
+		# cookies and headers are still handled by the requests session
+		session.mount('https://', HTTP2Adapter(max_streams))
+	return session
+
+class BandwidthLimiter(object):
+	# token bucket, without a rate it only counts the bytes
+	def __init__(self, rate=None):
+		self.rate   = rate
+		self.tokens = rate or 0
+		self.last   = time()
+		self.total  = 0
+		self.lock   = Lock()
+
+	def consume(self, size):
+		with self.lock:
+			self.total += size
+			if not self.rate:
+				return
+			now = time()
+			self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - size
+			self.last = now
+			delay = -self.tokens / self.rate
+		if delay > 0:
+			sleep(delay)
+
+class MirrorStats(object):
+	# unknown hosts score best, so every host gets tried
+	def __init__(self, alpha=MIRROR_ALPHA):
+		self.alpha = alpha
+		self.hosts = {} # host -> [latency, error rate, active downloads]
+		self.lock  = Lock()
+
+	def _score(self, url):
+		latency, errors, active = self.hosts.get(urlparse(url).netloc, (0, 0, 0))
+		return latency * (1 + active) + errors * MIRROR_ERROR_PENALTY
+
+	def order(self, urls):
+		with self.lock:
+			return sorted(urls, key=self._score)
+
+	def started(self, url):
+		with self.lock:
+			self.hosts.setdefault(urlparse(url).netloc, [0, 0, 0])[2] += 1
+
+	def finished(self, url, seconds, ok):
+		with self.lock:
+			host = self.hosts.setdefault(urlparse(url).netloc, [0, 0, 0])
+			host[2] = max(0, host[2] - 1)
+			if ok:
+				host[0] = seconds if host[0] == 0 else self.alpha * seconds + (1 - self.alpha) * host[0]
+			host[1] = self.alpha * (0 if ok else 1) + (1 - self.alpha) * host[1]
+
+def load_redundant_playlist(session, urls, headers, stats):
+	# the first playlist that loads is downloaded, the segments of the
+	# others become its mirrors
+	urls    = stats.order(urls)
+	results = [None] * len(urls) # (url, playlist) or exception
+
+	def load(i, url):
+		start_time = time()
+		stats.started(url)
+		try:
+			resp = session.get(url, headers=headers)
+			resp.raise_for_status()
+			results[i] = (url, parse_m3u8(resp.text, url))
+		except Exception as e:
+			results[i] = e
+		stats.finished(url, time() - start_time, not isinstance(results[i], Exception))
+
+	# live streams reload this every few seconds, so load the mirrors
+	# concurrently instead of waiting for one host after the other
+	threads = []
+	for i, url in enumerate(urls[1:], 1):
+		thread = Thread(target=load, args=(i, url), name='playlist mirror')
+		thread.daemon = True
+		threads.append(thread)
+		thread.start()
+
+	load(0, urls[0])
+	for thread in threads:
+		thread.join()
+
+	loaded = [result for result in results if not isinstance(result, Exception)]
+	if not loaded:
+		raise results[0]
+
+	m3u_url, playlist = loaded[0]
+	attach_mirrors(playlist.tracks, [mirror_playlist for url, mirror_playlist in loaded[1:]])
+	return m3u_url, playlist
+
+class ChunkBuffer(object):
+	# grows to the largest chunk it held and keeps that size when reused
+	def __init__(self):
+		self.data = bytearray(RECV_SIZE)
+		self.size = 0
+
+	def reserve(self, size):
+		if len(self.data) < size:
+			self.data.extend(bytearray(max(size, 2 * len(self.data)) - len(self.data)))
+
+	def write(self, data):
+		end = self.size + len(data)
+		self.reserve(end)
+		self.data[self.size:end] = data
+		self.size = end
+
+	def readfrom(self, raw, expected=None, limiter=None):
+		start = self.size
+		if expected:
+			self.reserve(start + expected)
+		while True:
+			if expected:
+				# urllib3 checks the content length, no need to read up to EOF
+				end = min(self.size + RECV_SIZE, start + expected)
+				if end == self.size:
+					break
+			else:
+				end = self.size + RECV_SIZE
+				self.reserve(end)
+			view = memoryview(self.data)[self.size:end]
+			try:
+				count = raw.readinto(view)
+			# wrapped like requests' iter_content does, so callers can fail over and retry
+			except urllib3.exceptions.ProtocolError as e:
+				raise requests.exceptions.ChunkedEncodingError(e)
+			except urllib3.exceptions.SSLError as e:
+				raise requests.exceptions.SSLError(e)
+			except urllib3.exceptions.HTTPError as e:
+				raise requests.ConnectionError(e)
+			finally:
+				# the buffer can't grow while it is referenced by a view
+				del view
+			if not count:
+				break
+			self.size += count
+			if limiter is not None:
+				limiter.consume(count)
+		return self.size - start
+
+	def view(self):
+		return memoryview(self.data)[:self.size]
+
+	def seek(self, pos):
+		self.size = pos
+
+	def truncate(self):
+		pass
+
+def replace_file(src, dst):
+	try:
+		os.rename(src, dst)
+	except OSError:
+		# Windows doesn't replace existing files
+		os.unlink(dst)
+		os.rename(src, dst)
+
+class DiskWriter(object):
+	# the bounded queue throttles the downloads while the disk is slow. With
+	# fsync_every chunks only get their final name once they are fsynced, in
+	# batches of that many or after FSYNC_INTERVAL seconds.
+	def __init__(self, events, buffers, fsync_every=0, tracer=NULL_TRACER):
+		self.events      = events
+		self.buffers     = buffers
+		self.fsync_every = fsync_every
+		self.tracer      = tracer
+		self.queue       = Queue(WRITE_QUEUE_SIZE)
+		self.failed      = False
+		self.thread      = Thread(target=self._run, name='disk writer')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, i, chunkpath, buf):
+		self.queue.put((i, chunkpath, buf, None))
+
+	def put_file(self, i, chunkpath, dlpath):
+		self.queue.put((i, chunkpath, None, dlpath))
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+
+	def _run(self):
+		pending = []
+		while True:
+			try:
+				if pending:
+					# don't hold back written chunks for too long while the downloads are slow
+					item = self.queue.get(timeout=max(pending[0][4] + FSYNC_INTERVAL - time(), 0))
+				else:
+					item = self.queue.get()
+			except Empty:
+				self._checkpoint(pending)
+				continue
+
+			if item is None:
+				self._checkpoint(pending)
+				break
+
+			i, chunkpath, buf, dlpath = item
+			try:
+				if self.failed:
+					pass
+				elif buf is None:
+					# append mode, because fsync needs a writable file on Windows
+					self._store(i, chunkpath, dlpath, open(dlpath, 'ab'), pending)
+				else:
+					self._write(i, chunkpath, buf, pending)
+			except Exception as e:
+				self._fail(e)
+			finally:
+				if buf is not None:
+					buf.seek(0)
+					self.buffers.put(buf)
+
+			if self.fsync_every > 0 and len(pending) >= self.fsync_every:
+				self._checkpoint(pending)
+
+	def _fail(self, error):
+		# keep draining the queue so the download threads get their buffers back
+		self.failed = True
+		self.events.put_nowait(('error', error))
+
+	def _write(self, i, chunkpath, buf, pending):
+		dlpath = chunkpath + '.download'
+		with self.tracer.span('disk write', 'disk', chunk=i, bytes=buf.size):
+			fp = open(dlpath, 'wb')
+			try:
+				fp.write(buf.view())
+			except:
+				fp.close()
+				raise
+
+		self._store(i, chunkpath, dlpath, fp, pending)
+
+	def _store(self, i, chunkpath, dlpath, fp, pending):
+		if self.fsync_every > 0:
+			pending.append((i, chunkpath, dlpath, fp, time()))
+		else:
+			fp.close()
+			with self.tracer.span('rename', 'disk', chunk=i):
+				replace_file(dlpath, chunkpath)
+			self.events.put_nowait(('chunk', i))
+
+	def _checkpoint(self, pending):
+		if not pending:
+			return
+
+		try:
+			with self.tracer.span('fsync', 'disk', chunks=len(pending)):
+				for i, chunkpath, dlpath, fp, written in pending:
+					fp.flush()
+					os.fsync(fp.fileno())
+					fp.close()
+
+				for i, chunkpath, dlpath, fp, written in pending:
+					replace_file(dlpath, chunkpath)
+
+				if os.name == 'posix':
+					# make the renames durable too
+					fd = os.open(os.path.dirname(os.path.abspath(pending[0][1])), os.O_RDONLY)
+					try:
+						os.fsync(fd)
+					finally:
+						os.close(fd)
+		except Exception as e:
+			for i, chunkpath, dlpath, fp, written in pending:
+				fp.close()
+			if not self.failed:
+				self._fail(e)
+		else:
+			for i, chunkpath, dlpath, fp, written in pending:
+				self.events.put_nowait(('chunk', i))
+
+		del pending[:]
+
+def fetch_track(session, track, headers, fp, stats, limiter=None, tracer=NULL_TRACER):
+	urls = stats.order([track.url] + track.meta.get('MIRRORS', []))
+	if 'BYTERANGE' in track.meta:
+		offset, length = track.meta['BYTERANGE']
+		headers = dict(headers, range='bytes=%d-%d' % (offset, offset + length - 1))
+	for index, url in enumerate(urls):
+		start_time = time()
+		stats.started(url)
+		try:
+			size = fetch_chunk(session, url, headers, fp, limiter, tracer)
+		except requests.RequestException:
+			stats.finished(url, time() - start_time, False)
+			if index + 1 == len(urls):
+				raise
+			fp.seek(0)
+			fp.truncate()
+		else:
+			stats.finished(url, time() - start_time, True)
+			return size
+
+def fetch_chunk(session, url, headers, fp, limiter=None, tracer=NULL_TRACER):
+	size = 0
+	# connecting and waiting for the response headers
+	with tracer.span('request', url=url):
+		resp = session.get(url, headers=headers, stream=True)
+	with closing(resp), tracer.span('body') as span:
+		resp.raise_for_status()
+		if isinstance(fp, ChunkBuffer) and hasattr(resp.raw, 'readinto') and \
+				resp.headers.get('content-encoding', 'identity') == 'identity':
+			length = resp.headers.get('content-length')
+			size = fp.readfrom(resp.raw, int(length) if length and length.isdigit() else None, limiter)
+		else:
+			for data in resp.iter_content(8192):
+				fp.write(data)
+				size += len(data)
+				if limiter is not None:
+					limiter.consume(len(data))
+		span.set('bytes', size)
+	return size
+
+def probe_throughput(session, m3u_url, headers, meter):
+	# time the download of the newest segment of the given media playlist
+	resp = session.get(m3u_url, headers=headers)
+	resp.raise_for_status()
+	playlist = parse_m3u8(resp.text, m3u_url)
+	if playlist.tracks:
+		start_time = time()
+		size = fetch_chunk(session, playlist.tracks[-1].url, headers, BytesIO())
+		meter.add(size, time() - start_time)
+
+class PartPrefetcher(object):
+	# the server answers a preload hint request as soon as the part exists
+	def __init__(self, session, headers, max_parts=PREFETCH_MAX_PARTS):
+		self.session   = session
+		self.headers   = headers
+		self.max_parts = max_parts
+		self.parts     = OrderedDict() # url -> data, None while in flight
+		self.lock      = Lock()
+		self.queue     = Queue()
+		# parts have to arrive in order, so one thread is enough
+		self.thread    = Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def prefetch(self, urls):
+		with self.lock:
+			for url in urls:
+				if url not in self.parts:
+					self.parts[url] = None
+					self.queue.put_nowait(url)
+			while len(self.parts) > self.max_parts:
+				self.parts.popitem(last=False)
+
+	def take(self, track):
+		parts = track.meta.get('PARTS')
+		if not parts:
+			return None
+		with self.lock:
+			if any(self.parts.get(url) is None for url in parts):
+				return None
+			return b''.join(self.parts.pop(url) for url in parts)
+
+	def _run(self):
+		while True:
+			url = self.queue.get()
+			if url is None:
+				break
+			with self.lock:
+				if url not in self.parts:
+					# already discarded
+					continue
+			buf = BytesIO()
+			try:
+				fetch_chunk(self.session, url, self.headers, buf)
+			except Exception:
+				# the segment will be downloaded normally instead
+				with self.lock:
+					self.parts.pop(url, None)
+			else:
+				with self.lock:
+					if url in self.parts:
+						self.parts[url] = buf.getvalue()
+
+	def close(self):
+		self.queue.put_nowait(None)
+
+class PlaylistRefresher(object):
+	# events: ('tracks', (m3u_url, mirrors, tracks)), ('end', None) and
+	# ('error', exception)
+	def __init__(self, session, headers, m3u_url, mirrors, tracks, events, gui,
+	             stats, variants=None, meter=None, prefetcher=None, skip_ads=False, tracer=NULL_TRACER):
+		self.session    = session
+		self.headers    = headers
+		self.m3u_url    = m3u_url
+		self.mirrors    = list(mirrors)
+		self.stats      = stats
+		self.tracks     = list(tracks)
+		self.events     = events
+		self.gui        = gui
+		self.variants   = variants or []
+		self.meter      = meter
+		self.prefetcher = prefetcher
+		self.skip_ads   = skip_ads
+		self.tracer     = tracer
+		self.stopped    = Event()
+		self.switch_samples = 0
+		self.pending_discontinuity = False
+		self.thread     = Thread(target=self._run, name='playlist refresh')
+		self.thread.daemon = True
+
+	def start(self):
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def _switch_variant(self):
+		if len(self.variants) < 2 or self.meter is None or not self.meter.estimate:
+			return
+
+		current = None
+		for track in self.variants:
+			if track.url == self.m3u_url:
+				current = track
+				break
+
+		variants = unique_variants(self.variants)
+		if current is not None:
+			current = variants[[variant_key(track) for track in variants].index(variant_key(current))]
+
+		variant = select_variant(variants, self.meter.estimate, current)
+		upgrade = current is not None and variant_sort_key(variant) > variant_sort_key(current)
+		if variant is not current and (not upgrade or
+				self.meter.samples - self.switch_samples >= SWITCH_UP_SEGMENTS):
+			self.gui.log('switching stream: %s' % variant.label())
+			self.m3u_url = variant.url
+			self.mirrors = variant_mirrors(self.variants, variant)
+			self.switch_samples = self.meter.samples
+			self.pending_discontinuity = True
+
+	def _run(self):
+		try:
+			while not self.stopped.is_set():
+				self._switch_variant()
+
+				urls = [self.m3u_url] + self.mirrors
+				try:
+					with self.tracer.span('playlist reload', 'playlist'):
+						m3u_url, playlist = load_redundant_playlist(self.session, urls, self.headers, self.stats)
+				except requests.HTTPError as e:
+					if e.response is not None and e.response.status_code in (404, 410):
+						# playlist is gone after the stream ended
+						self.events.put_nowait(('end', None))
+						return
+					raise
+
+				if m3u_url != self.m3u_url:
+					# failed over to (or just faster) mirror
+					self.m3u_url = m3u_url
+					self.mirrors = [url for url in urls if url != m3u_url]
+
+				added = new_tracks(self.tracks, playlist)
+				# skipped ads are remembered too, so they aren't reported again
+				self.tracks += added
+				if self.skip_ads:
+					added, self.pending_discontinuity = skip_ad_tracks(added, self.pending_discontinuity)
+				if added:
+					if self.pending_discontinuity:
+						# the stream was switched, timestamps and codec parameters may change here
+						added[0].meta['DISCONTINUITY'] = True
+						self.pending_discontinuity = False
+					self.events.put_nowait(('tracks', (self.m3u_url, self.mirrors, added)))
+
+				if self.prefetcher is not None:
+					urls = list(playlist.meta.get('PENDING-PARTS', []))
+					if 'EXT-X-PRELOAD-HINT' in playlist.meta:
+						urls.append(playlist.meta['EXT-X-PRELOAD-HINT'])
+					self.prefetcher.prefetch(urls)
+
+				if 'EXT-X-ENDLIST' in playlist.meta or not playlist.tracks:
+					self.events.put_nowait(('end', None))
+					return
+
+				# as recommended by the HLS spec wait a target duration after
+				# the playlist changed and half of it otherwise
+				interval = float(playlist.meta.get('EXT-X-TARGETDURATION', 2))
+				if not added:
+					interval /= 2
+				part_info = playlist.meta.get('EXT-X-PART-INF')
+				if part_info and self.prefetcher is not None:
+					interval = min(interval, float(part_info['PART-TARGET']))
+				self.stopped.wait(interval)
+		except Exception as e:
+			self.events.put_nowait(('error', e))
+
+class ChunkScheduler(object):
+	# leases that make no progress for lease_timeout are handed out again,
+	# the first one to complete() a chunk gets to store it
+	def __init__(self, lease_timeout=LEASE_TIMEOUT, retries=CHUNK_RETRIES):
+		self.lease_timeout = lease_timeout
+		self.retries  = retries
+		self.pending  = [] # heap of chunk indices
+		self.items    = {} # index -> (index, track, chunkpath) for all chunks not done yet
+		self.leases   = {} # lease id -> [set of indices, expiry time]
+		self.failures = {} # index -> failed downloads
+		self.next_lease = 1
+		self.closed  = False
+		self.cond    = Condition()
+
+	def put(self, item):
+		with self.cond:
+			self.items[item[0]] = item
+			heappush(self.pending, item[0])
+			self.cond.notify()
+
+	def take(self):
+		# None once the scheduler is closed
+		with self.cond:
+			while not self.closed:
+				self._expire()
+				if self.pending:
+					return self.items[heappop(self.pending)]
+				# wake up once in a while to hand out expired leases
+				self.cond.wait(1)
+			return None
+
+	def lease(self, count):
+		with self.cond:
+			self._expire()
+			if not self.pending:
+				return None, []
+
+			items = [self.items[heappop(self.pending)]]
+			while len(items) < count and self.pending and self.pending[0] == items[-1][0] + 1:
+				items.append(self.items[heappop(self.pending)])
+
+			lease_id = self.next_lease
+			self.next_lease += 1
+			self.leases[lease_id] = [set(item[0] for item in items), time() + self.lease_timeout]
+			return lease_id, items
+
+	def complete(self, index, lease_id=None):
+		# False if somebody else already completed this chunk
+		with self.cond:
+			self._release(index, lease_id)
+			return self.items.pop(index, None) is not None
+
+	def fail(self, index, lease_id=None):
+		# False once the chunk failed more than retries times, it isn't handed out again then
+		with self.cond:
+			if lease_id is not None and lease_id not in self.leases:
+				# the lease expired and the chunk was already handed out again
+				return True
+			self._release(index, lease_id)
+			self.failures[index] = self.failures.get(index, 0) + 1
+			if self.failures[index] > self.retries:
+				return False
+			if index in self.items and index not in self.pending:
+				heappush(self.pending, index)
+				self.cond.notify()
+			return True
+
+	def _release(self, index, lease_id):
+		lease = self.leases.get(lease_id)
+		if lease is not None:
+			indices, expires = lease
+			indices.discard(index)
+			if indices:
+				lease[1] = time() + self.lease_timeout
+			else:
+				del self.leases[lease_id]
+
+	def _expire(self):
+		now = time()
+		for lease_id, (indices, expires) in list(self.leases.items()):
+			if expires < now:
+				del self.leases[lease_id]
+				for index in indices:
+					if index in self.items and index not in self.pending:
+						heappush(self.pending, index)
+				self.cond.notify_all()
+
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+
+def parse_address(address):
+	if address.startswith('unix:'):
+		return socket.AF_UNIX, address[5:]
+	host, port = address.rsplit(':', 1)
+	return socket.AF_INET, (host or 'localhost', int(port, 10))
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		coordinator = self.server.coordinator
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				break
+			reply = coordinator.handle(json.loads(line.decode('utf-8')), self.rfile)
+			self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+			self.wfile.flush()
+
+class ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class Coordinator(object):
+	"""Line delimited JSON over TCP or a Unix socket. Workers send requests
+	and get one reply line for each:
+
+	  {"op": "hello"}                                  -> download settings
+	  {"op": "lease", "count": N}                      -> {"lease": ID, "chunks": [...]},
+	                                                      {"wait": SECONDS} or {"done": true}
+	  {"op": "chunk", "lease": ID, "index": I, "size": N} followed by N bytes
+	                                                   -> {"ok": true}
+	  {"op": "chunk", "lease": ID, "index": I, "path": PATH}
+	                                                   -> chunk was written to PATH on shared storage
+	  {"op": "failed", "lease": ID, "index": I, "error": MESSAGE}
+	                                                   -> hand the chunk out again, up to CHUNK_RETRIES times
+	"""
+
+	def __init__(self, address, scheduler, store, failed, settings):
+		self.scheduler = scheduler
+		self.store     = store # store(index, lease_id, data, path), data is None if written to path
+		self.failed    = failed # failed(index, message), the chunk ran out of retries
+		self.settings  = settings
+		family, addr   = parse_address(address)
+		if family == socket.AF_UNIX:
+			if os.path.exists(addr):
+				os.unlink(addr)
+			self.server = ThreadingUnixStreamServer(addr, CoordinatorHandler)
+		else:
+			self.server = ThreadingTCPServer(addr, CoordinatorHandler)
+		self.server.coordinator = self
+		self.thread = Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+
+	def start(self):
+		self.thread.start()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+		if isinstance(self.server, ThreadingUnixStreamServer) and os.path.exists(self.server.server_address):
+			os.unlink(self.server.server_address)
+
+	def handle(self, msg, rfile):
+		op = msg.get('op')
+		if op == 'hello':
+			return self.settings
+
+		elif op == 'lease':
+			lease_id, items = self.scheduler.lease(msg.get('count', LEASE_SIZE))
+			if not items:
+				return {'done': True} if self.scheduler.closed else {'wait': 1}
+			return {'lease': lease_id, 'chunks': [
+				{'index': i, 'url': track.url, 'meta': track.meta, 'path': os.path.abspath(chunkpath)}
+				for i, track, chunkpath in items]}
+
+		elif op == 'chunk':
+			data = rfile.read(msg['size']) if 'size' in msg else None
+			self.store(msg['index'], msg.get('lease'), data, msg.get('path'))
+			return {'ok': True}
+
+		elif op == 'failed':
+			if not self.scheduler.fail(msg['index'], msg.get('lease')):
+				self.failed(msg['index'], msg.get('error'))
+			return {'ok': True}
+
+		else:
+			return {'error': 'unknown op: %r' % op}
+
+class CoordinatorConnection(object):
+	def __init__(self, address):
+		family, addr = parse_address(address)
+		self.sock  = socket.socket(family, socket.SOCK_STREAM)
+		self.sock.connect(addr)
+		self.rfile = self.sock.makefile('rb')
+		self.wfile = self.sock.makefile('wb')
+
+	def call(self, msg, payload=None):
+		self.wfile.write(json.dumps(msg).encode('utf-8') + b'\n')
+		if payload is not None:
+			self.wfile.write(payload)
+		self.wfile.flush()
+		line = self.rfile.readline()
+		if not line:
+			raise EOFError('connection to coordinator closed')
+		return json.loads(line.decode('utf-8'))
+
+	def close(self):
+		self.rfile.close()
+		self.wfile.close()
+		self.sock.close()
+
+def run_worker(address, thread_count, shared_storage, gui):
+	# with shared_storage the coordinator's cache folder has to be available
+	# under the same path
+	with closing(CoordinatorConnection(address)) as conn:
+		settings = conn.call({'op': 'hello'})
+
+	headers = settings['headers']
+	stats   = MirrorStats()
+
+	with open_session(settings.get('http2', False)) as session:
+		session.cookies = requests.utils.cookiejar_from_dict(settings['cookies'])
+
+		def worker_func():
+			try:
+				lease_chunks()
+			except (EOFError, socket.error) as e:
+				gui.log('lost connection to coordinator: %s' % e)
+
+		def lease_chunks():
+			with closing(CoordinatorConnection(address)) as conn:
+				while True:
+					reply = conn.call({'op': 'lease', 'count': LEASE_SIZE})
+					if reply.get('done'):
+						break
+					elif 'wait' in reply:
+						sleep(reply['wait'])
+						continue
+
+					lease_id = reply['lease']
+					for chunk in reply['chunks']:
+						i = chunk['index']
+						track = Track(chunk['url'], chunk['meta'])
+						gui.log('downloading: %s -> %d.ts' % (track.url, i))
+						try:
+							if shared_storage and settings.get('shared_storage'):
+								# the coordinator renames it if this copy is the first to finish
+								dlpath = '%s.%d.download' % (chunk['path'], os.getpid())
+								try:
+									with open(dlpath, 'wb') as fp:
+										fetch_track(session, track, headers, fp, stats)
+								except:
+									os.remove(dlpath)
+									raise
+								conn.call({'op': 'chunk', 'lease': lease_id, 'index': i, 'path': dlpath})
+							else:
+								buf = BytesIO()
+								fetch_track(session, track, headers, buf, stats)
+								data = buf.getvalue()
+								conn.call({'op': 'chunk', 'lease': lease_id, 'index': i, 'size': len(data)}, data)
+						except requests.RequestException as e:
+							gui.log('error downloading %s: %s' % (track.url, e))
+							conn.call({'op': 'failed', 'lease': lease_id, 'index': i, 'error': str(e)})
+
+		workers = []
+		for i in range(thread_count):
+			thread = Thread(target=worker_func)
+			thread.daemon = True
+			workers.append(thread)
+			thread.start()
+
+		for thread in workers:
+			while thread.is_alive():
+				thread.join(0.5)
+
+def scan_cache(cachedir):
+	# chunks only get their final name once they are complete, leftovers of
+	# interrupted downloads are removed
+	cached = set()
+	try:
+		names = os.listdir(cachedir)
+	except OSError as e:
+		if e.errno == errno.ENOENT:
+			return cached
+		raise
+
+	for name in names:
+		index, ext = os.path.splitext(name)
+		if ext == '.ts' and index.isdigit():
+			cached.add(int(index))
+		elif re.match(r'\d+\.ts\.(\d+\.)?download$', name):
+			# N.ts.download of this process, N.ts.PID.download of remote workers
+			os.unlink(os.path.join(cachedir, name))
+
+	return cached
+
+def split_groups(tracks, count):
+	# every discontinuity starts a new range, apart from that any segment
+	# boundary is a safe split point because segments start with a keyframe
+	track_count = len(tracks)
+	bounds = set(index for index in range(1, track_count) if tracks[index].meta.get('DISCONTINUITY'))
+
+	if count > 1 and track_count > 1:
+		group_size = track_count / count
+		window = max(1, int(group_size / 4))
+		for k in range(1, count):
+			target = int(round(k * group_size))
+			bound  = target
+			for offset in sorted(range(-window, window + 1), key=abs):
+				if target + offset in bounds:
+					bound = target + offset
+					break
+			if 0 < bound < track_count:
+				bounds.add(bound)
+
+	bounds = [0] + sorted(bounds) + [track_count]
+	return list(zip(bounds, bounds[1:]))
+
+class ParallelRemuxer(object):
+	# a group is remuxed as soon as its chunks are downloaded, the parts are
+	# joined with ffmpeg's concat demuxer
+	def __init__(self, cachedir, tracks, outfile, jobs, progress, clips=None, tracer=NULL_TRACER):
+		self.cachedir = cachedir
+		self.outfile  = outfile
+		self.progress = progress
+		self.tracer   = tracer
+		if clips:
+			self.groups = [(start, end) for start, end, skip, length in clips]
+			self.trims  = [(skip, length) for start, end, skip, length in clips]
+		else:
+			self.groups = split_groups(tracks, jobs)
+			self.trims  = [(0, None)] * len(self.groups)
+		self.starts   = [start for start, end in self.groups]
+		self.missing  = [end - start for start, end in self.groups]
+		self.total    = sum(self.missing)
+		self.started  = [False] * len(self.groups)
+		self.threads  = []
+		self.procs    = []
+		self.errors   = []
+		self.written  = 0
+		self.killed   = False
+		self.lock     = Lock()
+		self.slots    = Semaphore(jobs)
+
+		ext = os.path.splitext(outfile)[1] or '.ts'
+		self.partpaths = [os.path.join(cachedir, 'part%d%s' % (index, ext)) for index in range(len(self.groups))]
+
+	def chunk_done(self, i):
+		# clips that share a segment overlap
+		for index in range(bisect_right(self.starts, i)):
+			if i < self.groups[index][1]:
+				self.missing[index] -= 1
+				if self.missing[index] == 0:
+					self._start(index)
+
+	def _start(self, index):
+		if not self.started[index]:
+			self.started[index] = True
+			start, end = self.groups[index]
+			thread = Thread(target=self._remux_group, args=(index, start, end), name='remux %d' % index)
+			thread.daemon = True
+			self.threads.append(thread)
+			thread.start()
+
+	def _feed(self, outfp, start, end):
+		try:
+			for i in range(start, end):
+				chunkpath = os.path.join(self.cachedir, '%d.ts' % i)
+				with self.tracer.span('assemble chunk', 'assemble', chunk=i):
+					with self.tracer.span('read'):
+						with open(chunkpath, 'rb') as chunkfp:
+							chunk = chunkfp.read()
+					# blocks while ffmpeg doesn't keep up
+					with self.tracer.span('ffmpeg write'):
+						outfp.write(chunk)
+				with self.lock:
+					self.written += 1
+				if self.progress.wasCancelled() or self.killed:
+					break
+		except IOError as e:
+			# ffmpeg exited early, the error is reported from its stderr
+			if e.errno != errno.EPIPE:
+				raise
+		finally:
+			outfp.close()
+
+	def _remux_group(self, index, start, end):
+		with self.slots:
+			if not self.progress.wasCancelled() and not self.killed:
+				self._remux(index, start, end)
+
+	def _remux(self, index, start, end):
+		cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'mpegts', '-i', '-']
+		skip, length = self.trims[index]
+		if skip > 0:
+			cmd += ['-ss', '%.3f' % skip]
+		if length is not None:
+			cmd += ['-t', '%.3f' % length]
+		cmd += ['-vcodec', 'copy', '-acodec', 'copy', self.partpaths[index]]
+		p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+		with self.lock:
+			self.procs.append(p)
+			if self.killed:
+				p.kill()
+
+		feeder = Thread(target=self._feed, args=(p.stdin, start, end), name='remux feed %d' % index)
+		feeder.daemon = True
+		feeder.start()
+
+		errmsg = p.stderr.read()
+		status = p.wait()
+		feeder.join()
+
+		if status != 0:
+			with self.lock:
+				self.errors.append('chunks %d-%d: %s' % (start, end - 1, errmsg.strip()))
+
+	def wait(self):
+		for index in range(len(self.groups)):
+			self._start(index)
+
+		for thread in self.threads:
+			while thread.is_alive():
+				thread.join(0.2)
+				self.progress.setValue(self.written)
+				if self.progress.wasCancelled():
+					self.kill()
+					raise KeyboardInterrupt
+
+		if self.errors:
+			raise Exception("Error assembling video!\n\n" + '\n'.join(self.errors))
+
+	def kill(self):
+		# groups that haven't started yet won't be started anymore
+		with self.lock:
+			self.killed = True
+			for p in self.procs:
+				if p.poll() is None:
+					p.kill()
+
+	def join(self):
+		listpath = os.path.join(self.cachedir, 'parts.txt')
+		with open(listpath, 'w') as fp:
+			for partpath in self.partpaths:
+				fp.write("file '%s'\n" % os.path.abspath(partpath).replace("'", "'\\''"))
+
+		check_call_errmsg(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+			'-i', listpath, '-c', 'copy', self.outfile])
+
+def pick_preview_tracks(tracks, count):
+	if len(tracks) <= count:
+		return list(tracks)
+
+	offsets = []
+	total = 0.0
+	for track in tracks:
+		offsets.append(total)
+		total += track.meta.get('DURATION', 0)
+
+	indices = []
+	for k in range(count):
+		if total > 0:
+			index = max(bisect_right(offsets, (k + 0.5) * total / count) - 1, 0)
+		else:
+			index = int((k + 0.5) * len(tracks) / count)
+		if not indices or indices[-1] != index:
+			indices.append(index)
+
+	return [tracks[index] for index in indices]
+
+def make_preview(session, headers, playlist, outfile, count, thread_count, progress, limiter=None):
+	# with an I-frame playlist only the keyframes are fetched. A %d in
+	# outfile writes one file per thumbnail, otherwise a contact sheet.
+	tracks = pick_preview_tracks(playlist.tracks, count)
+	if not tracks:
+		raise Exception("Playlist has no segments to preview.")
+
+	stats = MirrorStats()
+	init  = b''
+	if 'EXT-X-MAP' in playlist.meta:
+		# fragmented MP4 segments can only be decoded with their initialization section
+		segment_map = playlist.meta['EXT-X-MAP']
+		track = Track(segment_map['URI'])
+		if 'BYTERANGE' in segment_map:
+			track.meta['BYTERANGE'] = parse_byterange(segment_map['BYTERANGE'])
+		buf = BytesIO()
+		fetch_track(session, track, headers, buf, stats, limiter)
+		init = buf.getvalue()
+
+	if '%' in outfile:
+		thumbdir = None
+		pattern  = outfile
+	else:
+		thumbdir = tempfile.mkdtemp(prefix='preview')
+		pattern  = os.path.join(thumbdir, '%04d.png')
+
+	queue = Queue()
+	for index, track in enumerate(tracks):
+		queue.put_nowait((index + 1, track))
+	done = Queue()
+
+	def worker_func():
+		while True:
+			try:
+				number, track = queue.get_nowait()
+			except Empty:
+				break
+
+			if progress.wasCancelled():
+				done.put_nowait(KeyboardInterrupt())
+				break
+
+			try:
+				buf = BytesIO()
+				fetch_track(session, track, headers, buf, stats, limiter)
+				cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', '-', '-frames:v', '1',
+					'-vf', 'scale=%d:-2' % PREVIEW_WIDTH, pattern % number]
+				p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+				errmsg = p.communicate(init + buf.getvalue())[1]
+				if p.returncode != 0:
+					raise Exception("Error making thumbnail of %s:\n\n%s" % (track.url, errmsg.strip()))
+			except Exception as e:
+				done.put_nowait(e)
+			else:
+				done.put_nowait(None)
+
+	try:
+		for i in range(max(thread_count, 1)):
+			thread = Thread(target=worker_func)
+			thread.daemon = True
+			thread.start()
+
+		name = os.path.split(outfile)[1]
+		progress.setMaximum(len(tracks))
+		for finished in range(1, len(tracks) + 1):
+			error = done.get()
+			if error is not None:
+				raise error
+			progress.setValue(finished)
+			progress.setLabelText('Previewing »%s« %d/%d' % (name, finished, len(tracks)))
+			if progress.wasCancelled():
+				raise KeyboardInterrupt
+
+		if thumbdir is not None:
+			columns = 1
+			while columns * columns < len(tracks):
+				columns += 1
+			rows = (len(tracks) + columns - 1) // columns
+			check_call_errmsg(['ffmpeg', '-y', '-loglevel', 'error', '-framerate', '1', '-start_number', '1',
+				'-i', pattern, '-vf', 'tile=%dx%d' % (columns, rows), '-frames:v', '1', outfile])
+	finally:
+		if thumbdir is not None:
+			shutil.rmtree(thumbdir)
+
 def parse_curl(curl):
 	headers = {}
 	m3u_url = None
@@ -502,36 +2578,95 @@ def parse_curl(curl):
 
 	return m3u_url, headers
 
-def get_video_from_m3u(meta, outfile, gui):
+def get_video_from_m3u(meta, outfile, gui, adapters=None, limiter=None, tracer=NULL_TRACER):
+	spill      = None
+	streamfp   = None
+	refresher  = None
+	prefetcher = None
+	coordinator = None
+	writer     = None
+	scheduler  = ChunkScheduler()
 	try:
 		running    = True
 		headers    = meta['headers']
 		m3u_url    = meta['m3u_url']
+		# the url as given, m3u_url becomes the url of the chosen media playlist
+		meta.setdefault('source_url', m3u_url)
 		livestream = meta.get('livestream', False)
-		outname    = os.path.split(outfile)[1]
+		stream_output = is_stream_output(outfile)
+		outname    = 'stdout' if outfile == '-' else os.path.split(outfile)[1]
 		cachedir   = outfile + '.download'
 		metaname   = os.path.join(cachedir, 'download.json')
 		live_assemble = meta['live_assemble']
 		ffmpeg     = meta['ffmpeg']
 		keep_cache = meta['keep_cache']
 		thread_count = meta['thread_count']
-
-		if thread_count < 1:
+		buffer_size = meta.get('buffer_size', DEFAULT_BUFFER_SIZE)
+		auto_variant = meta.get('auto_variant', False)
+		variants   = [Track(tr['url'], tr['meta']) for tr in meta.get('variants', [])]
+		mirrors    = meta.get('mirrors', [])
+		mirror_stats = MirrorStats()
+		meter      = ThroughputMeter()
+		remux_jobs = meta.get('remux_jobs', 1)
+		remuxer    = None
+		prefetch_parts = meta.get('prefetch_parts', False)
+		http2      = meta.get('http2', False)
+		coordinator_address = meta.get('coordinator')
+		clips      = meta.get('clips') or []
+		exact_trim = meta.get('exact_trim', False)
+		clip_ranges = meta.get('clip_ranges')
+		skip_ads   = meta.get('skip_ads', False)
+		fsync_every = meta.get('fsync', 0)
+		preview    = meta.get('preview', 0)
+		# the live playlist as loaded, including skipped ads
+		loaded_tracks = None
+
+		if limiter is None and meta.get('max_bandwidth'):
+			limiter = BandwidthLimiter(meta['max_bandwidth'])
+
+		if thread_count < 1 and not coordinator_address:
 			raise ValueError('thread_count must be greater than or equal 1')
 
-		with requests.session() as session:
+		if remux_jobs < 1:
+			raise ValueError('remux_jobs must be greater than or equal 1')
+
+		if exact_trim and clips and (not ffmpeg or live_assemble or is_stream_output(outfile)):
+			raise ValueError('exact_trim needs ffmpeg and an output file')
+
+		if stream_output:
+			# chunks are passed on in order as soon as they are available,
+			# so there is nothing to resume and no cache folder is needed
+			spill = SpillBuffer(buffer_size)
+			if outfile == '-':
+				streamfp = getattr(sys.stdout, 'buffer', sys.stdout)
+			else:
+				streamfp = open(outfile, 'wb')
+			live_assemble = False
+
+		with open_session(http2, adapters=adapters) as session:
 			if 'cookies' in meta:
 				session.cookies = requests.utils.cookiejar_from_dict(meta['cookies'])
 
-			with gui.progressbar('Downloading »%s« ETA ---:--:--' % outname, 1) as progress:
+			with ProgressReporter(gui.progressbar('Downloading »%s« ETA ---:--:--' % outname, 1), PROGRESS_RATE, tracer) as progress:
+				cached  = set() if stream_output else scan_cache(cachedir)
+				resumed = None
 				if 'playlist' in meta:
 					pl = meta['playlist']
-					playlist = Playlist()
-					playlist.meta.update(pl['meta'])
+					resumed = Playlist()
+					resumed.meta.update(pl['meta'])
 					for tr in pl['tracks']:
 						track = Track(tr['url'], tr['meta'])
-						playlist.tracks.append(track)
-				else:
+						resumed.tracks.append(track)
+					playlist = resumed
+
+				# Segment urls (and the playlist urls Twitch or Periscope hand
+				# out) are usually signed with tokens that have expired when a
+				# download is resumed, so the original url is resolved again.
+				if resumed is None or livestream or not cached.issuperset(range(len(resumed.tracks))):
+					if resumed is not None:
+						m3u_url = meta['source_url']
+						gui.log('refreshing playlist: %s' % m3u_url)
+
 					resp = session.get(m3u_url, headers=headers)
 					resp.raise_for_status()
 					data = resp.text
@@ -652,106 +2787,301 @@ def get_video_from_m3u(meta, outfile, gui):
 
 					playlist = parse_m3u8(data, m3u_url)
 
-					if any(track.meta['STREAM'] for track in playlist.tracks):
+					if preview and resumed is None and playlist.meta.get('I-FRAME-STREAMS'):
+						# keyframes are all a preview needs, the smallest of them suffice
+						iframes = min(playlist.meta['I-FRAME-STREAMS'], key=lambda stream: stream.get('BANDWIDTH', 0))
+						m3u_url, playlist = load_redundant_playlist(session, [iframes['URI']], headers, mirror_stats)
+
+					elif any(track.meta['STREAM'] for track in playlist.tracks):
 						# it was only a master.m3u8 that points to more streams
 						# preselect the highest resolution (or last entry if there is no resolution information):
-						tracks = sorted(playlist.tracks, key=track_sort_key)
-
-						if len(tracks) == 1:
-							m3u_url = tracks[0].url
+						variants = playlist.tracks
+						distinct = unique_variants(variants)
+						tracks = sorted(distinct, key=track_sort_key)
+
+						# a resumed download continues with the stream it started with
+						chosen = [track for track in distinct if 'variant' in meta and
+						          variant_key(track) == variant_key(Track(None, meta['variant']))]
+
+						if chosen:
+							variant = chosen[0]
+						elif len(tracks) == 1:
+							variant = tracks[0]
+						elif auto_variant:
+							# measure what the link can sustain using the best stream
+							best = max(distinct, key=variant_sort_key)
+							probe_throughput(session, best.url, headers, meter)
+							variant = select_variant(distinct, meter.estimate) if meter.estimate else best
+							gui.log('selected stream: %s' % variant.label())
 						else:
-							items = [(track.url, track.label()) for track in playlist.tracks]
-							m3u_url = gui.menu('Please choose stream to download:', items, default=tracks[-1].url)
+							items = [(track.url, track.label()) for track in distinct]
+							url = gui.menu('Please choose stream to download:', items, default=tracks[-1].url)
+							variant = [track for track in distinct if track.url == url][0]
 
-						resp = session.get(m3u_url, headers=headers)
-						resp.raise_for_status()
-						data = resp.text
+						# the same stream may be offered by more hosts
+						urls = [variant.url] + variant_mirrors(variants, variant)
+						m3u_url, playlist = load_redundant_playlist(session, urls, headers, mirror_stats)
+						mirrors = [url for url in urls if url != m3u_url]
+						meta['variant'] = variant.meta
 
 						if progress.wasCancelled():
 							raise KeyboardInterrupt
 
-						playlist = parse_m3u8(data, m3u_url)
+					if resumed is not None:
+						# clips and skipped ads were already applied to the resumed playlist
+						unmatched = remap_tracks(resumed.tracks, playlist, not livestream)
+						gui.log('refreshed %d of %d segment urls' % (len(resumed.tracks) - len(unmatched), len(resumed.tracks)))
+						if livestream and unmatched:
+							# segments that left the live window can't be downloaded anymore
+							resumed.tracks, cached = drop_tracks(resumed.tracks, unmatched, cached, cachedir)
+						playlist.tracks = resumed.tracks
+
+					elif skip_ads:
+						loaded_tracks = playlist.tracks
+						playlist.tracks = skip_ad_tracks(playlist.tracks)[0]
+
+					if clips and resumed is None:
+						if livestream:
+							raise ValueError('time windows can only be cut out of a VOD')
+						playlist.tracks, clip_ranges = clip_tracks(playlist.tracks, clips)
+						if not playlist.tracks:
+							raise ValueError('time windows are outside of the video')
+						meta['clip_ranges'] = clip_ranges
+
+					if preview and resumed is None:
+						make_preview(session, headers, playlist, outfile, preview, thread_count, progress, limiter)
+						gui.passive_popup('Finished saving preview: '+outfile)
+						return
 
 					meta['m3u_url']    = m3u_url
 					meta['livestream'] = livestream
+					meta['variants']   = [{'url':track.url, 'meta':track.meta} for track in variants]
+					meta['mirrors']    = mirrors
 					meta['cookies']    = requests.utils.dict_from_cookiejar(session.cookies)
 					meta['playlist']   = {
 						'meta':   playlist.meta,
 						'tracks': [{'url':track.url, 'meta':track.meta} for track in playlist.tracks]
 					}
 
-					if not os.path.exists(cachedir):
-						os.mkdir(cachedir)
+					if not stream_output:
+						if not os.path.exists(cachedir):
+							os.mkdir(cachedir)
 
-					with open(metaname, 'wb') as fp:
-						json.dump(meta, fp)
+						with open(metaname, 'wb') as fp:
+							json.dump(meta, fp)
 
 				chunk_count = len(playlist.tracks)
 				finished_count = 0
 				missing_tracks = set()
 				finished_tracks = set()
 				last_track_written = -1
+				last_track_streamed = -1
+
+				if livestream and prefetch_parts:
+					prefetcher = PartPrefetcher(session, headers)
 
 				start_time = time()
 				finished_queue = Queue()
-				worker_queues = [Queue() for i in range(thread_count)]
+
+				if not stream_output:
+					# one receive buffer per download thread and one per queued write
+					buffers = Queue()
+					for i in range(thread_count + WRITE_QUEUE_SIZE + 1):
+						buffers.put_nowait(ChunkBuffer())
+					writer = DiskWriter(finished_queue, buffers, fsync_every, tracer)
 
 				for i in range(chunk_count):
 					chunkpath = os.path.join(cachedir, '%d.ts' % i)
-					if os.path.exists(chunkpath):
+					if i in cached:
 						finished_count += 1
 						finished_tracks.add(i)
 					else:
 						missing_tracks.add(i)
-						item = (i, playlist.tracks[i], chunkpath)
-						worker_queues[i % thread_count].put_nowait(item)
-
-				progress.setMaximum(len(missing_tracks))
-
-				def worker_func(queue):
+						scheduler.put((i, playlist.tracks[i], chunkpath))
+
+				progress.setMaximum(chunk_count)
+
+				def store_chunk(i, chunkpath, data=None, buf=None, lease_id=None, path=None):
+					# the first one to finish a chunk gets to store it
+					if not scheduler.complete(i, lease_id):
+						if buf is not None:
+							release_buffer(buf)
+						if path is not None:
+							os.remove(path)
+						return
+
+					with tracer.span('store', chunk=i):
+						if path is not None:
+							# the writer reports the chunk once it is on disk
+							writer.put_file(i, chunkpath, path)
+							return
+						elif spill is not None:
+							spill.put(i, data)
+						elif buf is not None:
+							# the writer reports the chunk once it is on disk
+							writer.put(i, chunkpath, buf)
+							return
+
+					finished_queue.put_nowait(('chunk', i))
+
+				def take_buffer():
+					with tracer.span('wait for buffer', 'disk'):
+						return buffers.get()
+
+				def release_buffer(buf):
+					buf.seek(0)
+					buffers.put(buf)
+
+				def worker_func():
 					while running:
-						item = queue.get()
+						with tracer.span('wait for chunk', 'queue'):
+							item = scheduler.take()
+						if item is None or progress.wasCancelled():
+							break
+						i, track, chunkpath = item
 						try:
-							if item is None:
+							with tracer.span('chunk', chunk=i):
+								download_chunk(i, track, chunkpath)
+						except requests.RequestException as e:
+							if not scheduler.fail(i):
+								finished_queue.put_nowait(('error', e))
 								break
-							i, track, chunkpath = item
-							dlpath = chunkpath + '.download'
+							gui.log('retrying chunk %d: %s' % (i, e))
+						except Exception as e:
+							finished_queue.put_nowait(('error', e))
+							break
+
+				def download_chunk(i, track, chunkpath):
+					data = prefetcher.take(track) if prefetcher is not None else None
+					if spill is not None:
+						with tracer.span('log', 'gui'):
+							gui.log('downloading: %s -> chunk %d' % (track.url, i))
+						if data is None:
+							buf = BytesIO()
+							fetch_start = time()
+							size = fetch_track(session, track, headers, buf, mirror_stats, limiter, tracer)
+							meter.add(size, time() - fetch_start)
+							data = buf.getvalue()
+						store_chunk(i, chunkpath, data=data)
+					else:
+						with tracer.span('log', 'gui'):
 							gui.log('downloading: %s -> %d.ts' % (track.url, i))
-							with open(dlpath, 'wb') as fp:
-								with closing(session.get(track.url, headers=headers, stream=True)) as resp:
-									resp.raise_for_status()
-									for data in resp.iter_content(8192):
-										fp.write(data)
-
-							if os.path.exists(chunkpath):
-								os.unlink(chunkpath)
-							os.rename(dlpath, chunkpath)
-
-							finished_queue.put_nowait(i)
-						finally:
-							queue.task_done()
+						buf = take_buffer()
+						try:
+							if data is None:
+								# waiting for a buffer is the disk's time, not the network's
+								fetch_start = time()
+								size = fetch_track(session, track, headers, buf, mirror_stats, limiter, tracer)
+								meter.add(size, time() - fetch_start)
+							else:
+								buf.write(data)
+						except:
+							release_buffer(buf)
+							raise
+						store_chunk(i, chunkpath, buf=buf)
 
 				workers = []
 				for i in range(thread_count):
-					thread = Thread(target=worker_func, args=(worker_queues[i],))
+					thread = Thread(target=worker_func, name='download %d' % i)
 					thread.daemon = True
 					workers.append(thread)
 					thread.start()
 
-				# signal end
-#				for queue in worker_queues:
-#					queue.put_nowait(None)
+				if coordinator_address:
+					def store_remote_chunk(i, lease_id, data, path):
+						chunkpath = os.path.join(cachedir, '%d.ts' % i)
+						if data is None:
+							# worker wrote the chunk to shared storage, next to its final name
+							if os.path.dirname(os.path.abspath(path)) != os.path.dirname(os.path.abspath(chunkpath)) or \
+							   not os.path.basename(path).startswith('%d.ts.' % i):
+								gui.log('ignoring chunk %d outside of the cache folder: %s' % (i, path))
+								if not scheduler.fail(i, lease_id):
+									remote_chunk_failed(i, 'chunk stored outside of the cache folder: %s' % path)
+								return
+							store_chunk(i, chunkpath, lease_id=lease_id, path=path)
+						elif spill is not None:
+							store_chunk(i, chunkpath, data=data, lease_id=lease_id)
+						else:
+							buf = take_buffer()
+							buf.write(data)
+							store_chunk(i, chunkpath, buf=buf, lease_id=lease_id)
+
+					def remote_chunk_failed(i, message):
+						finished_queue.put_nowait(('error', requests.RequestException(
+							'chunk %d failed %d times, last error: %s' % (i, CHUNK_RETRIES + 1, message))))
+
+					coordinator = Coordinator(coordinator_address, scheduler, store_remote_chunk, remote_chunk_failed, {
+						'headers': headers,
+						'cookies': requests.utils.dict_from_cookiejar(session.cookies),
+						'http2':   http2,
+						# streamed chunks never touch the cache folder
+						'shared_storage': not stream_output
+					})
+					coordinator.start()
 
 				if live_assemble:
 					assemblefp = open(outfile, 'wb')
 				else:
 					assemblefp = None
 
+				trims = clip_ranges if exact_trim else None
+				if ffmpeg and (remux_jobs > 1 or trims or has_discontinuity(playlist.tracks)) and not livestream and not stream_output and not live_assemble:
+					# the track list of a VOD is final, so groups can already
+					# be remuxed while the rest is still downloading
+					remuxer = ParallelRemuxer(cachedir, playlist.tracks, outfile, remux_jobs, progress, trims, tracer)
+					for i in finished_tracks:
+						remuxer.chunk_done(i)
+
+				live_ended = not livestream
+				if livestream:
+					refresher = PlaylistRefresher(session, headers, m3u_url, mirrors, loaded_tracks or playlist.tracks, finished_queue, gui,
+						mirror_stats, variants if auto_variant else None, meter, prefetcher, skip_ads, tracer)
+					refresher.start()
+
 				while running:
-					if missing_tracks:
-						tracknr = finished_queue.get()
-						missing_tracks.remove(tracknr)
-						finished_tracks.add(tracknr)
+					if missing_tracks or not live_ended:
+						with tracer.span('wait for event', 'queue'):
+							kind, value = finished_queue.get()
+						if kind == 'chunk':
+							missing_tracks.remove(value)
+							finished_tracks.add(value)
+							if remuxer is not None:
+								remuxer.chunk_done(value)
+
+						elif kind == 'tracks':
+							m3u_url, mirrors, added = value
+							playlist.tracks += added
+
+							if not stream_output:
+								meta['m3u_url']  = m3u_url
+								meta['mirrors']  = mirrors
+								meta['cookies']  = requests.utils.dict_from_cookiejar(session.cookies)
+								meta['playlist'] = {
+									'meta':   playlist.meta,
+									'tracks': [{'url':track.url, 'meta':track.meta} for track in playlist.tracks]
+								}
+
+								with open(metaname, 'wb') as fp:
+									json.dump(meta, fp)
+
+							new_chunk_count = len(playlist.tracks)
+							for i in range(chunk_count, new_chunk_count):
+								chunkpath = os.path.join(cachedir, '%d.ts' % i)
+								if i in cached:
+									finished_count += 1
+									finished_tracks.add(i)
+								else:
+									missing_tracks.add(i)
+									scheduler.put((i, playlist.tracks[i], chunkpath))
+
+							chunk_count = new_chunk_count
+							progress.setMaximum(chunk_count)
+
+						elif kind == 'end':
+							live_ended = True
+
+						else:
+							raise value
 
 					if live_assemble:
 						while last_track_written + 1 in finished_tracks:
@@ -764,9 +3094,22 @@ def get_video_from_m3u(meta, outfile, gui):
 								raise KeyboardInterrupt
 							print('last_track_written:', last_track_written, playlist.tracks[last_track_written].url)
 
+					if stream_output:
+						while last_track_streamed + 1 in spill:
+							last_track_streamed += 1
+							try:
+								with tracer.span('stream write', 'assemble', chunk=last_track_streamed):
+									streamfp.write(spill.pop(last_track_streamed))
+									streamfp.flush()
+							except IOError as e:
+								if e.errno == errno.EPIPE:
+									# reader went away, nothing more to do
+									raise KeyboardInterrupt
+								raise
+
 					dl_count = chunk_count - len(missing_tracks)
 					elapsed  = time() - start_time
-					avgtime  = elapsed / dl_count
+					avgtime  = elapsed / dl_count if dl_count else 0
 					esttime  = avgtime * chunk_count
 					remtime  = esttime - elapsed
 
@@ -775,64 +3118,10 @@ def get_video_from_m3u(meta, outfile, gui):
 					if progress.wasCancelled():
 						raise KeyboardInterrupt
 
-					if not missing_tracks:
-						if livestream:
-
-							# XXX: Bugs! Rewrite!
-							known_urls = set(track.url for track in playlist.tracks)
-							while True:
-								resp = session.get(m3u_url, headers=headers)
-								resp.raise_for_status()
-								data = resp.text
-								content_type = resp.headers['content-type'].split(";")[0]
-
-								if progress.wasCancelled():
-									raise KeyboardInterrupt
-
-								new_playlist = parse_m3u8(data, m3u_url)
-								for i, track in enumerate(new_playlist.tracks):
-									if track.url not in known_urls:
-										playlist.tracks += new_playlist.tracks[i:]
-										break
-
-								if len(playlist.tracks) > chunk_count:
-									break
-
-							meta['cookies']  = requests.utils.dict_from_cookiejar(session.cookies)
-							meta['playlist'] = {
-								'meta':   playlist.meta,
-								'tracks': [{'url':track.url, 'meta':track.meta} for track in playlist.tracks]
-							}
-
-							with open(metaname, 'wb') as fp:
-								json.dump(meta, fp)
-
-							new_chunk_count = len(playlist.tracks)
-
-							if len(new_playlist.tracks) == 0:
-								running = False
-								# signal end
-								for queue in worker_queues:
-									queue.put_nowait(None)
-							else:
-								for i in range(chunk_count, new_chunk_count):
-									chunkpath = os.path.join(cachedir, '%d.ts' % i)
-									if os.path.exists(chunkpath):
-										finished_count += 1
-										finished_tracks.add(i)
-									else:
-										missing_tracks.add(i)
-										item = (i, playlist.tracks[i - chunk_count], chunkpath)
-										worker_queues[i % thread_count].put_nowait(item)
-
-								chunk_count = new_chunk_count
-								progress.setMaximum(chunk_count)
-
-						else:
-							running = False
-							# signal end
-							for queue in worker_queues:
-								queue.put_nowait(None)
+					if not missing_tracks and live_ended:
+						running = False
+						# signal end
+						scheduler.close()
 
 				def concat_chunks(outfp):
 					try:
@@ -840,17 +3129,38 @@ def get_video_from_m3u(meta, outfile, gui):
 							progress.setValue(i + 1)
 							progress.setLabelText('Assembling »%s« %d/%d' % (outname, i+1, len(playlist.tracks)))
 							chunkpath = os.path.join(cachedir, '%d.ts' % i)
-							with open(chunkpath, 'rb') as chunkfp:
-								chunk = chunkfp.read()
-							outfp.write(chunk)
+							with tracer.span('assemble chunk', 'assemble', chunk=i):
+								with tracer.span('read'):
+									with open(chunkpath, 'rb') as chunkfp:
+										chunk = chunkfp.read()
+								# blocks while ffmpeg doesn't keep up
+								with tracer.span('write'):
+									outfp.write(chunk)
 							if progress.wasCancelled():
 								raise KeyboardInterrupt
 					finally:
 						outfp.close()
 
-				if live_assemble:
+				if stream_output:
+					# everything was already written while downloading
+					pass
+
+				elif live_assemble:
 					assemblefp.close()
 
+				elif ffmpeg and (remux_jobs > 1 or trims or has_discontinuity(playlist.tracks)):
+					if remuxer is None:
+						remuxer = ParallelRemuxer(cachedir, playlist.tracks, outfile, remux_jobs, progress, trims, tracer)
+
+					progress.setMaximum(remuxer.total)
+					progress.setValue(remuxer.written)
+					progress.setLabelText('Assembling »%s« in %d parts' % (outname, len(remuxer.groups)))
+
+					remuxer.wait()
+
+					progress.setLabelText('Joining »%s«' % outname)
+					remuxer.join()
+
 				elif ffmpeg:
 					progress.setMaximum(len(playlist.tracks))
 					progress.setValue(0)
@@ -862,7 +3172,7 @@ def get_video_from_m3u(meta, outfile, gui):
 					# can't pass thousands of files as arguments because
 					# ffmpeg tries to open them all at once and you get
 					# a too many open files error
-					write_thread = Thread(target=concat_chunks, args=(p.stdin, ))
+					write_thread = Thread(target=concat_chunks, args=(p.stdin, ), name='assemble')
 					write_thread.daemon = True
 					write_thread.start()
 
@@ -883,7 +3193,7 @@ def get_video_from_m3u(meta, outfile, gui):
 					with open(outfile, 'wb') as assemblefp:
 						concat_chunks(assemblefp)
 
-				if not keep_cache:
+				if not keep_cache and not stream_output:
 					shutil.rmtree(cachedir)
 
 		gui.passive_popup('Finished saving video: '+outfile)
@@ -893,12 +3203,327 @@ def get_video_from_m3u(meta, outfile, gui):
 		if outfile is not None:
 			gui.passive_popup('Download canceled by user: '+outfile)
 
+	finally:
+		scheduler.close()
+		if remuxer is not None:
+			# after an error ffmpeg would otherwise keep writing parts, once
+			# the video is assembled all of them already exited
+			remuxer.kill()
+		if coordinator is not None:
+			coordinator.close()
+		if refresher is not None:
+			refresher.stop()
+		if prefetcher is not None:
+			prefetcher.close()
+		if writer is not None:
+			writer.close()
+		if spill is not None:
+			spill.close()
+		if streamfp is not None and outfile != '-':
+			streamfp.close()
+
+class JobProgressBar(ProgressBar):
+	def __init__(self, job, label, maximum):
+		self.job = job
+		job.progress = {'label': label, 'value': 0, 'maximum': maximum}
+
+	def wasCancelled(self):
+		return self.job.cancelled.is_set()
+
+	def setMaximum(self, maximum):
+		self.job.progress['maximum'] = maximum
+
+	def setValue(self, value):
+		self.job.progress['value'] = value
+
+	def setLabelText(self, label):
+		self.job.progress['label'] = label
+
+class JobGUI(GUI):
+	def __init__(self, job):
+		super(JobGUI, self).__init__(sys.stderr)
+		self.job = job
+
+	def inputbox(self, msg, init=''):
+		raise ValueError('job needs input: %s' % msg)
+
+	def warning_yes_no(self, text):
+		return True
+
+	def menu(self, text, items, default=None):
+		return default if default is not None else items[-1][0]
+
+	def passive_popup(self, text, timeout=5):
+		print('[job %s] %s' % (self.job.id, text), file=self.out)
+
+	def show_error(self, text):
+		print('[job %s] *** Error: %s' % (self.job.id, text), file=self.out)
+
+	def progressbar(self, text, maximum):
+		return JobProgressBar(self.job, text, maximum)
+
+	def log(self, msg):
+		pass
+
+class Job(object):
+	def __init__(self, id, url, output, options, state='queued', error=None,
+	             created=None, started=None, finished=None):
+		self.id       = id
+		self.url      = url
+		self.output   = output
+		self.options  = options
+		self.state    = state
+		self.error    = error
+		self.created  = created or time()
+		self.started  = started
+		self.finished = finished
+		self.progress = None
+		self.cancelled = Event()
+
+	def to_json(self):
+		return {
+			'id':       self.id,
+			'url':      self.url,
+			'output':   self.output,
+			'options':  self.options,
+			'state':    self.state,
+			'error':    self.error,
+			'created':  self.created,
+			'started':  self.started,
+			'finished': self.finished
+		}
+
+	def status(self):
+		status = self.to_json()
+		status['progress'] = self.progress
+		return status
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+	def _reply(self, status, data):
+		body = json.dumps(data).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _job(self):
+		parts = self.path.strip('/').split('/')
+		if len(parts) == 2 and parts[0] == 'jobs':
+			return self.server.daemon.jobs.get(parts[1])
+		return None
+
+	def do_GET(self):
+		daemon = self.server.daemon
+		if self.path.rstrip('/') == '/jobs':
+			self._reply(200, [job.status() for job in list(daemon.jobs.values())])
+		elif self.path.rstrip('/') == '/metrics':
+			self._reply(200, daemon.metrics())
+		else:
+			job = self._job()
+			if job is None:
+				self._reply(404, {'error': 'not found'})
+			else:
+				self._reply(200, job.status())
+
+	def do_POST(self):
+		if self.path.rstrip('/') != '/jobs':
+			self._reply(404, {'error': 'not found'})
+			return
+		try:
+			length = int(self.headers.get('Content-Length') or 0)
+			data = json.loads(self.rfile.read(length).decode('utf-8'))
+			job = self.server.daemon.submit(data.get('url'), data.get('output'), data.get('options') or {})
+		except ValueError as e:
+			self._reply(400, {'error': str(e)})
+		else:
+			self._reply(201, job.status())
+
+	def do_DELETE(self):
+		job = self._job()
+		if job is None:
+			self._reply(404, {'error': 'not found'})
+		else:
+			self.server.daemon.cancel(job)
+			self._reply(200, job.status())
+
+	def log_message(self, format, *args):
+		pass
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class Daemon(object):
+	# jobs are persisted in jobs_dir, their resume state is the usual
+	# download.json in the cache folder of the output file
+	def __init__(self, address, jobs_dir, output_dir, max_jobs, max_bandwidth=None):
+		family, addr = parse_address(address)
+		if family != socket.AF_INET:
+			raise ValueError('the daemon can only listen on HOST:PORT, not %s' % address)
+
+		self.jobs_dir   = jobs_dir
+		self.output_dir = os.path.realpath(output_dir)
+		self.max_jobs   = max_jobs
+		self.jobs       = OrderedDict()
+		self.queue      = Queue()
+		self.limiter    = BandwidthLimiter(max_bandwidth)
+		self.start_time = time()
+		self.lock       = Lock()
+		self.ffmpeg     = has_ffmpeg()
+
+		adapter = SharedAdapter(requests.adapters.HTTPAdapter(
+			pool_connections=DAEMON_POOL_SIZE, pool_maxsize=DAEMON_POOL_SIZE))
+		self.adapters = {'http://': adapter, 'https://': adapter}
+
+		self.server = ThreadingHTTPServer(addr, DaemonRequestHandler)
+		self.server.daemon = self
+
+		if not os.path.exists(jobs_dir):
+			os.makedirs(jobs_dir)
+
+		jobs = []
+		for name in os.listdir(jobs_dir):
+			if name.endswith('.json'):
+				with open(os.path.join(jobs_dir, name), 'rb') as fp:
+					jobs.append(Job(**json.load(fp)))
+
+		for job in sorted(jobs, key=lambda job: job.created):
+			self.jobs[job.id] = job
+			if job.state in ('queued', 'running'):
+				# interrupted jobs continue where they stopped
+				job.state = 'queued'
+				self.queue.put_nowait(job)
+
+	def save(self, job):
+		path = os.path.join(self.jobs_dir, job.id + '.json')
+		with open(path + '.tmp', 'wb') as fp:
+			json.dump(job.to_json(), fp)
+		os.rename(path + '.tmp', path)
+
+	def submit(self, url, output, options):
+		if not url:
+			raise ValueError('url is required')
+		if not output or output == '-':
+			raise ValueError('output has to be a file name or named pipe')
+		unknown = set(options) - set(JOB_OPTIONS)
+		if unknown:
+			raise ValueError('unknown options: %s' % ', '.join(sorted(unknown)))
+		parse_curl(url)
+
+		# anyone who can reach the API can submit jobs, don't let them write anywhere
+		output = os.path.realpath(os.path.join(self.output_dir, output))
+		if not output.startswith(os.path.join(self.output_dir, '')):
+			raise ValueError('output has to be inside of %s' % self.output_dir)
+
+		job = Job(uuid.uuid4().hex, url, output, options)
+		with self.lock:
+			for other in list(self.jobs.values()):
+				if other.output == output and other.state in ('queued', 'running'):
+					raise ValueError('job %s already downloads to %s' % (other.id, output))
+			self.jobs[job.id] = job
+			self.save(job)
+		self.queue.put_nowait(job)
+		return job
+
+	def cancel(self, job):
+		with self.lock:
+			job.cancelled.set()
+			if job.state == 'queued':
+				job.state = 'canceled'
+				job.finished = time()
+				self.save(job)
+
+	def metrics(self):
+		states = {}
+		for job in list(self.jobs.values()):
+			states[job.state] = states.get(job.state, 0) + 1
+		uptime = time() - self.start_time
+		return {
+			'jobs':             states,
+			'max_jobs':         self.max_jobs,
+			'max_bandwidth':    self.limiter.rate,
+			'bytes_downloaded': self.limiter.total,
+			'average_rate':     self.limiter.total / uptime if uptime > 0 else 0,
+			'uptime':           uptime
+		}
+
+	def _run_job(self, job):
+		with self.lock:
+			if job.state != 'queued':
+				return
+			job.state   = 'running'
+			job.started = time()
+			self.save(job)
+
+		# JSON gives unicode strings on Python 2, but file names are byte strings there
+		output = job.output if isinstance(job.output, str) else job.output.encode(sys.getfilesystemencoding() or 'utf-8')
+		try:
+			metaname = os.path.join(output + '.download', 'download.json')
+			if os.path.exists(metaname):
+				with open(metaname, 'rb') as fp:
+					meta = json.load(fp)
+			else:
+				m3u_url, headers = parse_curl(job.url)
+				meta = dict(JOB_OPTIONS)
+				meta.update(job.options)
+				if meta['ffmpeg'] is None:
+					meta['ffmpeg'] = self.ffmpeg
+				meta['m3u_url'] = m3u_url
+				meta['headers'] = headers
+
+			get_video_from_m3u(meta, output, JobGUI(job), self.adapters, self.limiter)
+		except Exception as e:
+			traceback.print_exc()
+			state, job.error = 'failed', str(e)
+		else:
+			state = 'canceled' if job.cancelled.is_set() else 'finished'
+
+		with self.lock:
+			job.state    = state
+			job.finished = time()
+			self.save(job)
+
+	def _runner(self):
+		while True:
+			self._run_job(self.queue.get())
+
+	def run(self):
+		for i in range(self.max_jobs):
+			thread = Thread(target=self._runner)
+			thread.daemon = True
+			thread.start()
+		self.server.serve_forever()
+
 def main(args):
 	use_gui = None
 	live_assemble = False
 	ffmpeg = None
 	keep_cache = False
 	thread_count = 6
+	buffer_size = DEFAULT_BUFFER_SIZE
+	auto_variant = False
+	remux_jobs = 1
+	prefetch_parts = False
+	http2 = False
+	coordinator = None
+	worker = None
+	shared_storage = False
+	daemon = None
+	jobs_dir = os.path.join(os.path.expanduser('~'), '.get_video_from_m3u', 'jobs')
+	output_dir = '.'
+	max_jobs = 2
+	max_bandwidth = None
+	clips = []
+	start = None
+	end = None
+	exact_trim = False
+	skip_ads = False
+	preview = False
+	preview_count = 16
+	trace = None
+	trace_sample = 1
+	fsync_every = 0
 	while args:
 		arg = args[0]
 		if arg == '--gui':
@@ -918,6 +3543,102 @@ def main(args):
 			del args[0]
 		elif arg.startswith('--thread-count='):
 			thread_count = int(arg.split('=',1)[1])
+		elif arg == '--remux-jobs':
+			remux_jobs = int(args[1])
+			del args[0]
+		elif arg.startswith('--remux-jobs='):
+			remux_jobs = int(arg.split('=',1)[1])
+		elif arg == '--http2':
+			http2 = True
+		elif arg == '--no-http2':
+			http2 = False
+		elif arg == '--coordinator':
+			coordinator = args[1]
+			del args[0]
+		elif arg.startswith('--coordinator='):
+			coordinator = arg.split('=',1)[1]
+		elif arg == '--worker':
+			worker = args[1]
+			del args[0]
+		elif arg.startswith('--worker='):
+			worker = arg.split('=',1)[1]
+		elif arg == '--shared-storage':
+			shared_storage = True
+		elif arg == '--start':
+			start = parse_time(args[1])
+			del args[0]
+		elif arg.startswith('--start='):
+			start = parse_time(arg.split('=',1)[1])
+		elif arg == '--end':
+			end = parse_time(args[1])
+			del args[0]
+		elif arg.startswith('--end='):
+			end = parse_time(arg.split('=',1)[1])
+		elif arg == '--clip':
+			clips.append(parse_clip(args[1]))
+			del args[0]
+		elif arg.startswith('--clip='):
+			clips.append(parse_clip(arg.split('=',1)[1]))
+		elif arg == '--exact-trim':
+			exact_trim = True
+		elif arg == '--skip-ads':
+			skip_ads = True
+		elif arg == '--trace':
+			trace = args[1]
+			del args[0]
+		elif arg.startswith('--trace='):
+			trace = arg.split('=',1)[1]
+		elif arg == '--trace-sample':
+			trace_sample = int(args[1])
+			del args[0]
+		elif arg.startswith('--trace-sample='):
+			trace_sample = int(arg.split('=',1)[1])
+		elif arg == '--fsync':
+			fsync_every = int(args[1])
+			del args[0]
+		elif arg.startswith('--fsync='):
+			fsync_every = int(arg.split('=',1)[1])
+		elif arg == '--preview':
+			preview = True
+		elif arg == '--preview-count':
+			preview_count = int(args[1])
+			del args[0]
+		elif arg.startswith('--preview-count='):
+			preview_count = int(arg.split('=',1)[1])
+		elif arg == '--daemon':
+			daemon = args[1]
+			del args[0]
+		elif arg.startswith('--daemon='):
+			daemon = arg.split('=',1)[1]
+		elif arg == '--jobs-dir':
+			jobs_dir = args[1]
+			del args[0]
+		elif arg.startswith('--jobs-dir='):
+			jobs_dir = arg.split('=',1)[1]
+		elif arg == '--output-dir':
+			output_dir = args[1]
+			del args[0]
+		elif arg.startswith('--output-dir='):
+			output_dir = arg.split('=',1)[1]
+		elif arg == '--max-jobs':
+			max_jobs = int(args[1])
+			del args[0]
+		elif arg.startswith('--max-jobs='):
+			max_jobs = int(arg.split('=',1)[1])
+		elif arg == '--max-bandwidth':
+			max_bandwidth = parse_size(args[1])
+			del args[0]
+		elif arg.startswith('--max-bandwidth='):
+			max_bandwidth = parse_size(arg.split('=',1)[1])
+		elif arg == '--prefetch-parts':
+			prefetch_parts = True
+		elif arg == '--auto-variant':
+			auto_variant = True
+		elif arg == '--buffer-size':
+			buffer_size = parse_size(args[1])
+			del args[0]
+		elif arg.startswith('--buffer-size='):
+			buffer_size = parse_size(arg.split('=',1)[1])
 		elif arg == '--help':
 			_has_kdialog = has_kdialog()
 			_has_ffmpeg = has_ffmpeg()
@@ -935,6 +3656,76 @@ OPTIONS:
 	--no-ffmpeg           Just concatenate the downloaded chunks.{no_ffmpeg}
 	--keep-cache          Keep cache folder and files after finishing download.
 	--thread-count=COUNT  Use COUNT threads for downloading.
+	--buffer-size=SIZE    When streaming to stdout (output file name "-") or to
+	                      a named pipe keep up to SIZE bytes of out of order
+	                      chunks in memory before spilling them to a temporary
+	                      folder. (default: 64M)
+	--fsync=COUNT         Flush downloaded chunks to disk in batches of up to
+	                      COUNT chunks, so a resumed download can trust every
+	                      chunk in the cache folder even after a crash or
+	                      power loss. This includes chunks that workers wrote
+	                      with --shared-storage. (default: 0, leave it to the
+	                      OS)
+	--auto-variant        Choose the stream of a master playlist by the measured
+	                      throughput instead of asking. Live streams switch to
+	                      a lower or higher quality stream when the throughput
+	                      changes.
+	--remux-jobs=COUNT    Remux the chunks in COUNT contiguous parts with one
+	                      ffmpeg process each and join the parts afterwards.
+	                      Parts of a VOD are remuxed while the rest is still
+	                      downloading. (only with --ffmpeg, default: 1)
+	--prefetch-parts      Prefetch the parts of low-latency live streams as
+	                      announced by preload hints, so new segments are
+	                      available without downloading them after they
+	                      are published.
+	--http2               Multiplex all requests to a HTTPS server over one
+	                      HTTP/2 connection. (needs h2)
+	--no-http2            Use one HTTP/1.1 connection per download thread.
+	                      (default)
+	--coordinator=ADDRESS Let worker processes (see --worker) download chunks
+	                      too. ADDRESS is HOST:PORT or unix:PATH to listen on.
+	                      --thread-count=0 leaves all downloads to the workers.
+	--worker=ADDRESS      Run as a worker for the coordinator at ADDRESS instead
+	                      of downloading a video. Uses --thread-count threads.
+	--shared-storage      As worker write chunks directly to the cache folder of
+	                      the coordinator, which has to be available under the
+	                      same path (e.g. on the same host or a network share).
+	--max-bandwidth=RATE  Download at most RATE bytes per second, e.g. 2M.
+	--start=TIME          Only download the segments from TIME on. TIME is
+	                      [[HH:]MM:]SS[.fff] from the start of the video.
+	--end=TIME            Only download the segments up to TIME.
+	--clip=START-END      Only download the segments covering START to END.
+	                      Can be given multiple times, the clips are joined.
+	--exact-trim          Cut the clips to their exact times instead of the
+	                      boundaries of the covering segments. Uses stream
+	                      copy, so the start of a clip may show artifacts
+	                      until its first keyframe. (needs --ffmpeg)
+	--skip-ads            Don't download the segments of ad breaks marked by
+	                      EXT-X-CUE-OUT/IN or SCTE-35 EXT-X-DATERANGE tags.
+	                      Times of --start/--end/--clip don't count the ads.
+	--preview             Save thumbnails instead of the video. Only keyframes
+	                      of the I-frame playlist are downloaded if there is
+	                      one. The output file name is an image that gets a
+	                      contact sheet of all thumbnails, or a pattern like
+	                      thumb%03d.jpg for single thumbnails. (needs ffmpeg)
+	--preview-count=COUNT Number of thumbnails. (default: 16)
+	--trace=FILE          Write a timeline of the downloads, disk writes,
+	                      assembly, playlist reloads and progress updates per
+	                      thread to FILE. Open it in chrome://tracing or
+	                      https://ui.perfetto.dev/
+	--trace-sample=N      Only trace every N-th chunk download, assembly step,
+	                      playlist reload etc. of each thread. (default: 1)
+	--daemon=HOST:PORT    Run as a daemon that downloads jobs submitted with
+	                      POST /jobs {{"url": URL, "output": FILE, "options": {{}}}}
+	                      to http://HOST:PORT. GET /jobs, GET /jobs/ID and
+	                      DELETE /jobs/ID query and cancel jobs, GET /metrics
+	                      reports totals. --max-bandwidth is shared by all jobs.
+	--jobs-dir=DIR        Where the daemon keeps its job queue.
+	                      (default: ~/.get_video_from_m3u/jobs)
+	--output-dir=DIR      The daemon only writes output files inside of DIR,
+	                      relative output file names are relative to it.
+	                      (default: current directory)
+	--max-jobs=COUNT      Number of jobs the daemon runs at once. (default: 2)
 """.format(
 		gui       = ' (default)' if     _has_kdialog else '',
 		no_gui    = ' (default)' if not _has_kdialog else '',
@@ -951,18 +3742,40 @@ OPTIONS:
 
 		del args[0]
 
+	if start is not None or end is not None:
+		clips.append([start or 0.0, end])
+
 	if use_gui is None:
 		use_gui = has_kdialog()
 
 	if ffmpeg is None:
 		ffmpeg = has_ffmpeg()
 
-	if ffmpeg:
+	if preview:
+		ext_filter = '*.jpg, *.png'
+	elif ffmpeg:
 		ext_filter = '*.mp4, *.mkv, *.ts, *.mpeg'
 	else:
 		ext_filter = '*.ts'
 
-	with (KDialogGUI() if use_gui else TextGUI()) as gui:
+	if daemon is not None:
+		print('listening on http://%s/' % daemon)
+		Daemon(daemon, jobs_dir, output_dir, max_jobs, max_bandwidth).run()
+		return
+
+	if worker is not None:
+		with (KDialogGUI() if use_gui else TextGUI()) as gui:
+			try:
+				run_worker(worker, thread_count, shared_storage, gui)
+			except Exception as e:
+				traceback.print_exc()
+				gui.show_error(str(e))
+		return
+
+	# keep stdout clean when the video itself is written to it
+	out = sys.stderr if args[:1] == ['-'] else sys.stdout
+
+	with (KDialogGUI(out) if use_gui else TextGUI(out)) as gui:
 		try:
 			if len(args) < 1:
 				outfile = gui.get_save_filename(filter=ext_filter)
@@ -973,7 +3786,7 @@ OPTIONS:
 			metaname = os.path.join(cachedir, 'download.json')
 			meta = None
 
-			if os.path.exists(metaname):
+			if not is_stream_output(outfile) and os.path.exists(metaname):
 				if gui.warning_yes_no('Continue in progress download?'):
 					with open(metaname, 'rb') as fp:
 						meta = json.load(fp)
@@ -990,10 +3803,26 @@ OPTIONS:
 					'live_assemble': live_assemble,
 					'ffmpeg': ffmpeg,
 					'keep_cache': keep_cache,
-					'thread_count': thread_count
+					'thread_count': thread_count,
+					'buffer_size': buffer_size,
+					'auto_variant': auto_variant,
+					'remux_jobs': remux_jobs,
+					'prefetch_parts': prefetch_parts,
+					'http2': http2,
+					'coordinator': coordinator,
+					'max_bandwidth': max_bandwidth,
+					'clips': clips,
+					'exact_trim': exact_trim,
+					'skip_ads': skip_ads,
+					'preview': preview_count if preview else 0,
+					'fsync': fsync_every
 				}
 
-			get_video_from_m3u(meta, outfile, gui)
+			tracer = Tracer(trace, trace_sample) if trace else NULL_TRACER
+			try:
+				get_video_from_m3u(meta, outfile, gui, tracer=tracer)
+			finally:
+				tracer.close()
 
 		except Exception as e:
 			traceback.print_exc()